@@ -7,24 +7,25 @@ from ..GAT3D.GATMultistream import Model
 from ..train import test
 import json
 import time
-from ..utils import get_number_parameters, model_classes
+from ..utils import find_rainy, get_number_parameters, model_classes
 import ipdb
 
 
 def get_metrics(models, models_folders, preprocessed_folder, downsample_size):
     device = t.device("cuda" if t.cuda.is_available() else "cpu")
     results = {}
+    # one loader for all models, every `test` call starts a new pass over it
+    train_loader, test_loader, _ = get_loaders(
+        train_batch_size=2,
+        test_batch_size=100,
+        preprocessed_folder=preprocessed_folder,
+        device=device,
+        downsample_size=downsample_size,
+        dataset="kmni",
+        merge_nodes=False,
+        shuffle=True,
+    )
     for model_folder, model in zip(models_folders, models):
-        train_loader, test_loader, _ = get_loaders(
-            train_batch_size=2,
-            test_batch_size=100,
-            preprocessed_folder=preprocessed_folder,
-            device=device,
-            downsample_size=downsample_size,
-            dataset="kmni",
-            merge_nodes=False,
-            shuffle=True,
-        )
         t0 = time.time()
         metrics = test(model, device, test_loader)
         t1 = time.time()
@@ -36,28 +37,26 @@ def get_metrics(models, models_folders, preprocessed_folder, downsample_size):
 
 def plot(out_path, loader, models):
     _fig, ax = plt.subplots(nrows=len(folders) + 1, ncols=4)
-    for x, y in loader:
-        for k in range(len(x)):
-            raininess = y[k][y[k] != 0].numel() / y[k].numel()
-            if raininess >= 0.3:
-                preds = [model(x)[k] for model in models]
-                to_plot = [y[k]] + preds
-                to_plot = [t.pow(tp, 1 / loader.power) for tp in to_plot]
-                for i, row in enumerate(ax):
-                    for j, col in enumerate(row):
-                        col.imshow(to_plot[i].cpu().detach().numpy()[:, :, j, 1])
+    found = find_rainy(loader, 0.3, part="y")
+    if found is not None:
+        x, y, (k,) = found
+        preds = [model(x)[k] for model in models]
+        to_plot = [y[k]] + preds
+        to_plot = [t.pow(tp, 1 / loader.power) for tp in to_plot]
+        for i, row in enumerate(ax):
+            for j, col in enumerate(row):
+                col.imshow(to_plot[i].cpu().detach().numpy()[:, :, j, 1])
 
-                row_labels = ["y"] + [" ".join(f.split("_")[1:]) for f in folders]
-                for ax_, row in zip(ax[:, 0], row_labels):
-                    ax_.set_ylabel(row)
+        row_labels = ["y"] + [" ".join(f.split("_")[1:]) for f in folders]
+        for ax_, row in zip(ax[:, 0], row_labels):
+            ax_.set_ylabel(row)
 
-                col_labels = ["frame1", "frame2", "frame3", "frame4"]
-                for ax_, col in zip(ax[0, :], col_labels):
-                    ax_.set_title(col)
+        col_labels = ["frame1", "frame2", "frame3", "frame4"]
+        for ax_, col in zip(ax[0, :], col_labels):
+            ax_.set_title(col)
 
-                plt.savefig(os.path.join(out_path, f"multi_model_plot.png"))
-                plt.close()
-                return
+        plt.savefig(os.path.join(out_path, f"multi_model_plot.png"))
+        plt.close()
 
 
 def json_to_table(data: dict, out_path: str):
@@ -7,6 +7,7 @@ import json
 import ipdb
 from argparse import ArgumentParser
 from .data_loaders.get_loaders import get_loaders
+from .utils import find_rainy
 from .model import SpatialModel, TemporalModel
 import matplotlib.pyplot as plt
 from .unet_model import UnetModel
@@ -22,12 +23,9 @@ def create_comparison_plot(
     dataset="kmni",
     max_preds=1,
 ):
-    plt.clf()
     with t.no_grad():
         N_COLS = 4  # frames
         N_ROWS = 2 + len(models)  # x, y, preds
-        # plt.title(f"Epoch {epoch}")
-        _fig, ax = plt.subplots(nrows=N_ROWS, ncols=N_COLS)
         # for model_file in enumerate(models):
         device = t.device("cuda" if t.cuda.is_available() else "cpu")
         # merge_nodes = issubclass(UnetModel, type(model))
@@ -41,58 +39,57 @@ def create_comparison_plot(
             dataset=dataset,
             merge_nodes=merge_nodes,
         )
-        for x, y in loader:
-            for k in range(len(x)):
-                raininess = t.sum(x[k] != 0) / t.prod(t.tensor(x[k].shape))
-                if raininess >= 0.5:
-                    # preds = model(x)
-                    # to_plot = [x[k], y[k], preds[k]]
-                    to_plot = [x[k], y[k]]
-                    row_labels = ["x", "y"]
-                    for model_obj, model_file in models:
-                        model = model_obj
-                        model.load_state_dict(
-                            t.load(
-                                os.getcwd()
-                                + "/convolutional_gat/experiments/"
-                                + model_file
-                                + "/model.pt"
-                            )
-                        )
-                        # model = t.jit.load()
-                        model.to(device)
-                        model.eval()
-                        preds = model(x)
-                        to_plot.append(preds[k])
-                        row_labels.append(model_file)
-
-                    for i, row in enumerate(ax):
-                        for j, col in enumerate(row):
-                            # ipdb.set_trace()
-                            col.imshow(
-                                to_plot[i].cpu().detach().numpy()[:, :, j, 1]
-                                if not merge_nodes
-                                else to_plot[i]
-                                .cpu()
-                                .detach()
-                                .numpy()[j, : downsample_size[0], : downsample_size[1],]
-                            )
+        found = find_rainy(loader, 0.5, n=max_preds)
+        if found is not None:
+            x, y, ks = found
+            # the predictions of every model, for all the windows plotted
+            all_preds = []
+            row_labels = ["x", "y"]
+            for model_obj, model_file in models:
+                model = model_obj
+                model.load_state_dict(
+                    t.load(
+                        os.getcwd()
+                        + "/convolutional_gat/experiments/"
+                        + model_file
+                        + "/model.pt"
+                    )
+                )
+                # model = t.jit.load()
+                model.to(device)
+                model.eval()
+                all_preds.append(model(x))
+                row_labels.append(model_file)
 
-                    for ax_, row in zip(ax[:, 0], row_labels):
-                        ax_.set_ylabel(row)
+            for k in ks:
+                plt.clf()
+                # plt.title(f"Epoch {epoch}")
+                _fig, ax = plt.subplots(nrows=N_ROWS, ncols=N_COLS)
+                to_plot = [x[k], y[k]] + [preds[k] for preds in all_preds]
+                for i, row in enumerate(ax):
+                    for j, col in enumerate(row):
+                        # ipdb.set_trace()
+                        col.imshow(
+                            to_plot[i].cpu().detach().numpy()[:, :, j, 1]
+                            if not merge_nodes
+                            else to_plot[i]
+                            .cpu()
+                            .detach()
+                            .numpy()[j, : downsample_size[0], : downsample_size[1],]
+                        )
 
-                    col_labels = ["frame1", "frame2", "frame3", "frame4"]
-                    for ax_, col in zip(ax[0, :], col_labels):
-                        ax_.set_title(col)
+                for ax_, row in zip(ax[:, 0], row_labels):
+                    ax_.set_ylabel(row)
 
-                    plt.savefig(
-                        f"{os.getcwd()}/convolutional_gat/models_comparison/pred_{k}.png"
-                    )
-                    plt.close()
-                    # model.train()
+                col_labels = ["frame1", "frame2", "frame3", "frame4"]
+                for ax_, col in zip(ax[0, :], col_labels):
+                    ax_.set_title(col)
 
-                    if (k + 1) == max_preds:
-                        return
+                plt.savefig(
+                    f"{os.getcwd()}/convolutional_gat/models_comparison/pred_{k}.png"
+                )
+                plt.close()
+            # model.train()
 
 
 if __name__ == "__main__":
@@ -1,87 +1,98 @@
 import torch as t
-from threading import Thread
 import os
 import numpy as np
 import ipdb
 from enum import Enum, unique
 from tqdm import tqdm
 import json
+from functools import lru_cache
+from sequence_data.datasets import DeviceLoader, WindowIterableDataset
+from sequence_data.loader import SequenceLoader
+from sequence_data.sources import PtSource
+from sequence_data.windows import split_windows
+from ..preprocessing.pyramid import pick_level
 
 # todo: shuffling
 # todo: fix the fist batch is empty
 
 
-class DataLoader:
+# cached so that loaders can be rebuilt without listing the folders again
+@lru_cache(maxsize=None)
+def list_block_files(folder: str) -> tuple[str, ...]:
+    return tuple(
+        sorted(
+            (f for f in os.listdir(folder) if f.endswith(".pt")),
+            key=lambda x: int(x.split(".")[0]),
+        )
+    )
+
+
+@lru_cache(maxsize=None)
+def read_metadata(preprocessed_folder: str) -> dict:
+    with open(os.path.join(preprocessed_folder, "metadata.json")) as f:
+        return json.load(f)
+
+
+class DataLoader(SequenceLoader):
+    # windows of 2 * time_steps frames of every block, in time order unless
+    # shuffled; the last frames of a block are not dropped
     def __init__(
         self,
         batch_size: int,
         folder: str,
         device,
         *,
-        total_length: int,
         n_regions: int = 5,
         time_steps: int = 4,
         norm_max=None,
         norm_min=None,
         downsample_size: tuple[int, int] = (256, 256,),  # by default, don't downsample
+        rank: int = 0,
+        world_size: int = 1,
+        drop_last: bool = False,
+        shuffle: bool = False,
+        seed: int = 0,
+        num_workers: int = 2,
+        queue_size: int = 4,
+        read_ahead: int = 4,
     ):
-        self.total_length = total_length
         self.n_regions = n_regions
         self.downsample_size = downsample_size
         self.folder = folder
-        self.device = device
-        self.__is_first = True
         self.norm_max = norm_max
         self.norm_min = norm_min
-        self.batch_size = batch_size
         self.time_steps = time_steps
-        self.__batch_size = batch_size
-        self.__next_batch = (t.tensor([]), t.tensor([]))
-        self.__remainder = (t.tensor([]), t.tensor([]))
-        self.file_index = 0
-        self.should_stop_iteration = False
-        self.files = sorted(
-            [f for f in os.listdir(folder)], key=lambda x: int(x.split(".")[0])
-        )
+        self.files = list_block_files(folder)
         max_file = max(int(f.split(".")[0]) for f in self.files)
         # print(f"{max_file=}")
         self.item_count = 86 * len(self.files)
-        self.thread = Thread(target=self.__get_batch)
-        # print(f"{self.files=}")
-        # print(f"{self.item_count=}")
-
-    def __len__(self):
-        tot = self.total_length - (self.time_steps - 1) * (len(self.files) + 1)
-        return tot // self.__batch_size
-
-    def __batchify(self, data: t.Tensor) -> tuple[t.Tensor, t.Tensor]:
-        result = (t.tensor([]), t.tensor([]))
-        """
-        shifted = t.stack(
-            tuple(
-                data[i : i + self.time_steps]
-                for i in range(len(data) - (self.time_steps - 1))
-            )
+        super().__init__(
+            # the blocks being batched by the workers are kept decoded
+            PtSource(folder, files=self.files, cache_size=num_workers + 1),
+            batch_size,
+            device,
+            in_len=time_steps,
+            out_len=time_steps,
+            crop=downsample_size,
+            truncate=False,
+            shuffle=shuffle,
+            dtype=None,
+            seed=seed,
+            rank=rank,
+            world_size=world_size,
+            drop_last=drop_last,
+            num_workers=num_workers,
+            queue_size=queue_size,
+            read_ahead=read_ahead,
         )
-        even_mask = t.arange(len(shifted)) % 2 == 0
-        xs = shifted[even_mask]
-        labels = shifted[t.logical_not(even_mask)]
-        min_len = min(len(xs), len(labels))
-        result = (xs[:min_len], labels[:min_len])
-        """
-        chunks = tuple(
-            data[i : i + 2 * self.time_steps]
-            for i in range(len(data) - (2 * self.time_steps - 1))
+        # `read_ahead` counts files, the loader reads ahead by batches of a file
+        batches_per_file = max(
+            (-(-self.n_windows(i) // batch_size) for i in range(len(self.source))),
+            default=1,
         )
-        xs = []
-        ys = []
-        for chunk in chunks:
-            xs.append(chunk[: self.time_steps])
-            ys.append(chunk[self.time_steps :])
-        tensor_xs = t.stack(xs)
-        tensor_ys = t.stack(ys)
-
-        return (tensor_xs, tensor_ys)
+        self.read_ahead = read_ahead * max(batches_per_file, 1)
+        # print(f"{self.files=}")
+        # print(f"{self.item_count=}")
 
     def fix_sizes(self, tensor1: t.Tensor, tensor2: t.Tensor):
         tensor1 = tensor1.squeeze(3)  # same
@@ -92,100 +103,56 @@ class DataLoader:
         tensor2 = tensor2.permute(0, 3, 4, 1, 2)
         return tensor1, tensor2
 
-    def __iter__(self):
-        return self
+    def output(self, batch: t.Tensor) -> tuple[t.Tensor, t.Tensor]:
+        return self.fix_sizes(*split_windows(batch, self.time_steps))
 
-    def __next__(self) -> tuple[t.Tensor, t.Tensor]:
-        if self.should_stop_iteration:
-            # print(f"Number of files read: {self.file_index} out of {len(self.files)}")
-            raise StopIteration
 
-        if self.thread.is_alive():
-            self.thread.join()
-        if self.__is_first:
-            self.__is_first = False
-            self.__get_batch()
-        current_batch = self.__next_batch
-        self.__next_batch = None
-        if not self.should_stop_iteration:
-            try:
-                self.thread.start()
-            except:
-                self.thread = Thread(target=self.__get_batch)
-                self.thread.start()
-        # print(f"{result[0].shape=}")
-        return self.fix_sizes(
-            current_batch[0].to(self.device), current_batch[1].to(self.device),
+class TorchDataLoader(DeviceLoader):
+    # The same windows, in time order, through torch.utils.data worker
+    # processes: blocks of consecutive windows are dealt to the ranks, then
+    # each worker gets whole files, which are decoded once
+    def __init__(
+        self,
+        batch_size: int,
+        folder: str,
+        device,
+        *,
+        n_regions: int = 5,
+        time_steps: int = 4,
+        downsample_size: tuple[int, int] = (256, 256),
+        rank: int = 0,
+        world_size: int = 1,
+        drop_last: bool = False,
+        num_workers: int = 4,
+        block: int = 64,
+    ):
+        self.folder = folder
+        self.n_regions = n_regions
+        self.downsample_size = downsample_size
+        self.time_steps = time_steps
+        dataset = WindowIterableDataset(
+            PtSource(folder, files=list_block_files(folder)),
+            2 * time_steps,
+            crop=downsample_size,
+            truncate=False,
+            block=block,
+            shuffle=False,
+            rank=rank,
+            world_size=world_size,
+            drop_last=drop_last,
+            whole_sequences=True,
+        )
+        super().__init__(
+            dataset,
+            batch_size,
+            device,
+            in_len=time_steps,
+            transform=self.__fix_size,
+            num_workers=num_workers,
         )
 
-    def __read_next_file(self) -> t.Tensor:
-        if self.file_index == len(self.files):
-            self.should_stop_iteration = True
-        # tensor = t.tensor([[]])
-        # while (
-        #    tensor.shape[1] < 5
-        # ):  # TODO: some files have apparently only 5 in the second dimension, could mean there is a bug in the preprocessing or the data is not perfect
-        # while tensor.shape[1] < 5:
-        tensor = t.load(os.path.join(self.folder, f"{self.files[self.file_index]}"))
-        # assert (
-        #    tensor.shape[1] == self.n_regions
-        # ), f"Found a tensor that is not of the right shape {tensor.shape=}"
-        # print(f"{tensor.shape=}")
-        # if len(tensor.shape) > 5:
-        #    ipdb.set_trace()
-        tensor = tensor[:, :, :, : self.downsample_size[0], : self.downsample_size[1]]
-        # print(f"{tensor.shape=}")
-        # if tensor.shape[1] < 5:
-        # print("skipping")
-        # ipdb.set_trace()
-        #    pass
-
-        # print(self.file_index)
-        # print(self.files[self.file_index])
-        self.file_index += 1
-        if self.file_index == len(self.files):
-            self.should_stop_iteration = True
-        return tensor
-
-    def __get_batch(self):
-        # accumulator = self.__remainder
-        if len(self.__remainder[0]) > 0:
-            self.__next_batch = (
-                self.__remainder[0][: self.__batch_size],
-                self.__remainder[1][: self.__batch_size],
-            )
-            self.__remainder = (
-                self.__remainder[0][self.__batch_size :],
-                self.__remainder[1][self.__batch_size :],
-            )
-        else:
-            data = self.__batchify(self.__read_next_file())
-            self.__remainder = (
-                data[0][self.__batch_size :],
-                data[1][self.__batch_size :],
-            )
-            self.__next_batch = (
-                data[0][: self.__batch_size],
-                data[1][: self.__batch_size],
-            )
-        """ 
-        while (
-            len(accumulator) < self.__batch_size
-            and not self.should_stop_iteration
-        ):
-            to_be_gained = self.__batch_size - len(accumulator)
-            next_batch = self.__read_next_file()
-            new_data = next_batch[:to_be_gained]
-            # print(f"{new_data.shape=}")
-            # print(f"{accumulator.shape=}")
-            accumulator = (
-                new_data
-                if len(accumulator) == 0
-                else t.cat((accumulator, new_data))
-            )
-            self.__remainder = next_batch[to_be_gained:]
-        self.__next_batch = accumulator
-        """
+    def __fix_size(self, tensor: t.Tensor) -> t.Tensor:
+        return tensor.squeeze(3).permute(0, 3, 4, 1, 2)
 
 
 def get_loaders(
@@ -195,23 +162,51 @@ def get_loaders(
     device,
     *,
     downsample_size: tuple[int, int] = (256, 256),
+    rank: int = 0,
+    world_size: int = 1,
+    pyramid: bool = False,
+    torch_workers: int = 0,
 ):
-    with open(os.path.join(preprocessed_folder, "metadata.json")) as f:
-        metadata = json.load(f)
+    if pyramid:
+        # the smallest pooled level whose frames still cover downsample_size
+        preprocessed_folder, _ = pick_level(preprocessed_folder, downsample_size)
+    metadata = read_metadata(preprocessed_folder)
+    if torch_workers > 0:
+        # worker processes instead of threads
+        return tuple(
+            TorchDataLoader(
+                batch_size,
+                os.path.join(preprocessed_folder, split),
+                device,
+                n_regions=metadata["n_regions"],
+                downsample_size=downsample_size,
+                rank=rank if split == "training" else 0,
+                world_size=world_size if split == "training" else 1,
+                num_workers=torch_workers,
+            )
+            for split, batch_size in (
+                ("training", train_batch_size),
+                ("validation", test_batch_size),
+                ("validation", test_batch_size),
+            )
+        )
     return (
         DataLoader(
             train_batch_size,
             os.path.join(preprocessed_folder, "training"),
             device,
-            total_length=metadata["training"]["length"],
             downsample_size=downsample_size,
             n_regions=metadata["n_regions"],
+            rank=rank,
+            world_size=world_size,
+            # sharded ranks get other blocks every epoch, a single process
+            # keeps reading them in time order
+            shuffle=world_size > 1,
         ),
         DataLoader(
             test_batch_size,
             os.path.join(preprocessed_folder, "validation"),
             device,
-            total_length=metadata["validation"]["length"],
             downsample_size=downsample_size,
             n_regions=metadata["n_regions"],
         ),
@@ -219,7 +214,6 @@ def get_loaders(
             test_batch_size,
             os.path.join(preprocessed_folder, "validation"),
             device,
-            total_length=metadata["validation"]["length"],
             downsample_size=downsample_size,
             n_regions=metadata["n_regions"],
         ),
@@ -13,7 +13,16 @@ def get_loaders(
     dataset: str = "kmni",
     downsample_size: tuple[int, int] = (256, 256),
     merge_nodes: bool = False,
-    shuffle=True
+    shuffle=True,
+    use_store: bool = False,
+    global_shuffle: bool = False,
+    rain_weight: float = None,
+    rank: int = 0,
+    world_size: int = 1,
+    use_layout: bool = False,
+    pyramid: bool = False,
+    torch_workers: int = 0,
+    split_scheme: str = None,
 ):
     if dataset == "arai":
         return get_loaders_arai(
@@ -22,6 +31,10 @@ def get_loaders(
             preprocessed_folder,
             device,
             downsample_size=downsample_size,
+            rank=rank,
+            world_size=world_size,
+            pyramid=pyramid,
+            torch_workers=torch_workers,
         )
     elif dataset == "kmni":
         return get_loaders_kmni(
@@ -32,4 +45,13 @@ def get_loaders(
             crop=downsample_size[0],
             merge_nodes=merge_nodes,
             shuffle=shuffle,
+            use_store=use_store,
+            global_shuffle=global_shuffle,
+            rain_weight=rain_weight,
+            rank=rank,
+            world_size=world_size,
+            use_layout=use_layout,
+            pyramid=pyramid,
+            torch_workers=torch_workers,
+            split_scheme=split_scheme,
         )
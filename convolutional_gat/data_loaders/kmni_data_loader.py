@@ -1,5 +1,4 @@
 import torch as t
-from threading import Thread
 import os
 import matplotlib.pyplot as plt
 import numpy as np
@@ -7,13 +6,54 @@ import ipdb
 from enum import Enum, unique
 from tqdm import tqdm
 import json
-from ..preprocessing.utils import listdir
+from ..preprocessing.stats import split_stats
+from ..preprocessing.pyramid import pick_level
+from sequence_data.loader import SequenceLoader
+from sequence_data.window_store import WindowStore, list_sequence_files, open_store
+from sequence_data.window_index import (
+    WindowSampler,
+    load_window_index,
+    window_rain_stats,
+)
+from sequence_data.datasets import DeviceLoader, SampledBatches, WindowDataset
+from sequence_data.sources import PtSource, StoreSource
+from sequence_data.splits import (
+    DEFAULT_SCHEME,
+    file_ids,
+    read_splits,
+    select_files,
+    split_path,
+)
+from .window_layout import WindowLayout, merge_nodes, open_layout, to_layout
 
 # todo: shuffling
 # todo: fix the fist batch is empty
 
 
-class DataLoader:
+class FrameDecoder:
+    # batches stay uint8 until they reach the device, where they are decoded
+    # with a lookup table of every normalized and transformed value
+    def __init__(self, power: float, device, normalizing_max: int = 254):
+        self.power = t.tensor(power)
+        self.normalizing_max = normalizing_max
+        self.lut = t.pow(t.arange(256) / normalizing_max, self.power).to(device)
+
+    def __call__(self, batch: t.Tensor) -> t.Tensor:
+        if batch.dtype == t.uint8:
+            return self.lut[batch.long()]
+        return t.pow(batch / self.normalizing_max, self.power.to(batch.device))
+
+
+def load_uint8(path: str) -> t.Tensor:
+    # sequences written before they were stored as uint8 are converted when
+    # their values fit, so batches stay small until they reach the device
+    data = t.load(path)
+    if data.dtype != t.uint8 and data.min() >= 0 and data.max() <= 255:
+        data = data.to(t.uint8)
+    return data
+
+
+class DataLoader(SequenceLoader):
     def __init__(
         self,
         batch_size: int,
@@ -24,110 +64,359 @@ class DataLoader:
         crop=None,
         shuffle: bool = True,
         merge_nodes: bool = False,
-        power: float = 1.0
+        power: float = 1.0,
+        store: WindowStore = None,
+        layout: WindowLayout = None,
+        global_shuffle: bool = False,
+        files_in_flight: int = 8,
+        num_samples: int = None,
+        rain_weight: float = None,
+        rank: int = 0,
+        world_size: int = 1,
+        drop_last: bool = False,
+        num_workers: int = 2,
+        queue_size: int = 4,
+        read_ahead: int = 4,
+        seed: int = None,
+        files: list[str] = None,
+        split: str = None,
     ):
-        self.power = t.tensor(power)
+        self.decode = FrameDecoder(power, device)
+        self.power = self.decode.power
+        self.normalizing_max = self.decode.normalizing_max
         # metadata = t.load(os.path.join(folder, "../metadata.pt"))
         self.data_folder = folder
-        self.normalizing_max = 254
         self.merge_nodes = merge_nodes
-        self.crop = crop
-        self.device = device
-        self.batch_size = batch_size
-        self.file_index = 0
+        self.time_steps = time_steps
         self.folder = folder
-        self.files = tuple(
-            os.path.join(folder, fn) for fn in sorted(os.listdir(folder))
+        # with a window store, sequences are read from the memory map by index
+        self.store = store
+        # with a window layout, batches are read already in the model layout
+        self.layout = layout
+        if self.layout is not None:
+            assert (
+                layout.time_steps == time_steps
+                and layout.crop == crop
+                and layout.merged == merge_nodes
+            ), f"the window layout in {layout.folder} was written for other options"
+        # `files` restricts the loader to a split of the sequences of the
+        # folder (see sequence_data/splits.py); the window index and the rain
+        # statistics are those of the whole folder, shared by all of its splits
+        if self.store is not None:
+            self.folder_files = self.store.files
+        else:
+            self.folder_files = list_sequence_files(folder)
+        self.file_ids = file_ids(self.folder_files, files)
+        self.file_names = tuple(self.folder_files[i] for i in self.file_ids)
+        # the name of the split in cached statistics
+        if split is None:
+            split = os.path.basename(os.path.normpath(folder))
+        self.split = split
+        # a layout holds the windows of the whole folder, those of a part of its
+        # sequences are read through the window index
+        subset = len(self.file_ids) < len(self.folder_files)
+        sampled = (
+            global_shuffle
+            or rain_weight is not None
+            or world_size > 1
+            or (subset and layout is not None)
         )
-        self.shuffle = shuffle
-        if self.shuffle:
-            rand_indices = t.randperm(len(self.files))
-            tmp = tuple(self.files[i] for i in rand_indices)
-            self.files = tmp
-        self.remainder = self.__read_next_file()
-        self.file_length = self.remainder.shape[0] * self.remainder.shape[1]
-
-    def stats(self):
-        # all_training =
-        flat = t.cat(tuple(t.load(fp) for fn, fp in listdir(self.data_folder))).view(-1)
-        bins = np.unique(flat)
-        """
-        hist, _ = np.histogram(flat, bins)
-        plt.plot(np.arange(hist), hist)
-        """
-        norm = (flat - t.mean(self.normalizing_mean)) / t.mean(self.normalizing_var)
-        hist, _ = np.histogram(norm, len(bins))
-        plt.plot(np.arange(len(hist)), hist)
-
-        plt.show()
-        ipdb.set_trace()
-        # plt.hist(flat, bins="auto")
-        # ipdb.set_trace()
-
-    def __read_next_file(self) -> t.Tensor:
-        if self.file_index == len(self.files):
-            raise StopIteration
-        data = t.load(self.files[self.file_index])
-        self.file_index += 1
-        result = self.__segmentify(data)
-        return result
-
-    def __segmentify(self, data: t.Tensor) -> t.Tensor:
-        data = data[: (len(data) // 8) * 8]
-        norm_data = data / self.normalizing_max
-        data = t.pow(norm_data, self.power)
-        segments = t.stack(
-            tuple(
-                el
-                for el in tuple(data[i : i + 8] for i in range(len(data)))
-                if len(el) == 8
+        if store is not None:
+            source = StoreSource(store, files=self.file_names)
+        else:
+            # sampled windows are drawn from groups of `files_in_flight` files
+            # that are kept decoded, sequences read in order from a few at once
+            source = PtSource(
+                folder,
+                files=self.file_names,
+                cache_size=2 * files_in_flight if sampled else num_workers + 1,
+                load=load_uint8,
             )
+        super().__init__(
+            source,
+            batch_size,
+            device,
+            in_len=time_steps,
+            out_len=time_steps,
+            crop=crop,
+            shuffle=shuffle,
+            dtype=None,
+            seed=seed,
+            rank=rank,
+            world_size=world_size,
+            drop_last=drop_last,
+            num_workers=num_workers,
+            queue_size=queue_size,
+            read_ahead=read_ahead,
         )
-        """
-        segments = data.view(
-            -1, 8, data.shape[1], data.shape[2], data.shape[3]
-        )
-        """
-        split_segments = t.stack(
-            tuple(t.stack((s[:4], s[4:])) for s in segments)
-        ).transpose(0, 1)
-        if self.crop is not None:
-            split_segments = split_segments[:, :, :, :, : self.crop, : self.crop]
-        if self.merge_nodes:
-            split_segments = t.cat(
-                tuple(
-                    t.cat(
-                        (split_segments[:, :, :, i], split_segments[:, :, :, i + 1],),
-                        dim=3,
-                    )
-                    for i in range(3)
+        self.sampler = None
+        self.index = None
+        self.folder_index = None
+        self.index_rows = None
+        self.rain = None
+        self.layout_starts = None
+        if self.layout is not None:
+            # rows of the layout are the rows of the window index of the folder
+            self.window_index()
+            assert self.layout.files == self.folder_files and len(self.layout) == len(
+                self.folder_index
+            ), f"the window layout in {layout.folder} is out of date"
+        if sampled:
+            # windows are drawn from the whole split through the window index,
+            # which is also what is split between ranks;
+            # the memory map allows true random access, .pt files are shuffled,
+            # or their weighted draws ordered, in groups of `files_in_flight`
+            # that are kept decoded in a cache
+            weights = None
+            if rain_weight is not None:
+                # rainy windows are drawn (1 + rain_weight * raininess) times as
+                # often as dry ones, with replacement
+                rain = self.window_stats()
+                weights = t.from_numpy(1 + rain_weight * (rain["x"] + rain["y"]) / 2)
+            self.sampler = WindowSampler(
+                self.window_index(),
+                batch_size,
+                shuffle=shuffle,
+                files_in_flight=None if store is not None else files_in_flight,
+                num_samples=num_samples,
+                weights=weights,
+                seed=self.seed,
+                rank=rank,
+                world_size=world_size,
+                drop_last=drop_last,
+            )
+
+    def window_index(self) -> np.ndarray:
+        if self.index is None:
+            self.folder_index = load_window_index(
+                self.folder,
+                self.folder_files,
+                self.window_size,
+                lengths=(
+                    None
+                    if self.store is None
+                    else np.diff(self.store.offsets).tolist()
                 ),
-                dim=4,
             )
-        return split_segments
+            self.index, self.index_rows = select_files(
+                self.folder_index, self.file_ids
+            )
+        return self.index
 
-    def __next__(self) -> tuple[t.Tensor, t.Tensor]:
-        if self.remainder.shape[1] == 0:
-            data = self.__read_next_file()
-        else:
-            data = self.remainder
-        self.remainder = data[:, self.batch_size :]
-        result = data[:, : self.batch_size].to(self.device)
-        rand_indices = (
-            t.randperm(result.shape[1]) if self.shuffle else t.arange(result.shape[1])
+    def window_stats(self) -> dict[str, np.ndarray]:
+        # raininess of the input ("x") and target ("y") frames and mean
+        # intensity of every row of the window index, for the loader's crop
+        if self.rain is None:
+            self.window_index()
+            rain = window_rain_stats(
+                self.folder,
+                self.folder_files,
+                self.folder_index,
+                self.window_size,
+                self.time_steps,
+                crop=self.crop,
+                load=self.__load_folder_id,
+            )
+            self.rain = {key: val[self.index_rows] for key, val in rain.items()}
+        return self.rain
+
+    def find_rainy(self, threshold: float = 0.5, part: str = "x", n: int = 1):
+        # a batch of n windows drawn among those at least `threshold` rainy,
+        # None when there are none
+        rainy = np.flatnonzero(self.window_stats()[part] >= threshold)
+        if len(rainy) == 0:
+            return None
+        generator = t.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        chosen = rainy[t.randperm(len(rainy), generator=generator)[:n].numpy()]
+        slot, batch = next(self.__index_batches(self.window_index()[chosen]))
+        return self.output(self.to_device(slot, batch))
+
+    def set_epoch(self, epoch: int):
+        if self.sampler is not None:
+            self.sampler.set_epoch(epoch)
+        super().set_epoch(epoch)
+
+    def tasks(self):
+        if self.sampler is not None:
+            return self.sampler
+        if self.layout is not None:
+            # contiguous slices of the layout, in shuffled order
+            starts = t.arange(0, len(self.layout), self.batch_size)
+            if self.shuffle:
+                generator = t.Generator()
+                generator.manual_seed(self.seed + self.epoch)
+                starts = starts[t.randperm(len(starts), generator=generator)]
+            return starts.tolist()
+        # batches of consecutive windows of the sequences, in shuffled order
+        return super().tasks()
+
+    def read_batch(self, task):
+        if self.sampler is not None:
+            return self.__index_batches(task)
+        if self.layout is not None:
+            return self.__layout_batches(task)
+        return super().read_batch(task)
+
+    def stats(self, num_workers: int = 4, plot: bool = False) -> dict:
+        # cached in the dataset metadata after the first call
+        summary = split_stats(
+            os.path.dirname(os.path.normpath(self.data_folder)),
+            self.split,
+            num_workers,
+            files=[os.path.join(self.folder, fn) for fn in self.file_names],
         )
-        if self.merge_nodes:
-            result = result.permute(0, 1, 2, 3, 4)
+        if plot and summary.get("histogram") is not None:
+            hist = np.array(summary["histogram"])
+            values = t.pow(t.arange(len(hist)) / self.normalizing_max, self.power)
+            plt.plot(values.numpy(), hist)
+            plt.yscale("log")
+            plt.show()
+        return summary
+
+    def __layout_starts(self) -> np.ndarray:
+        # first row of every sequence of the folder in the layout
+        if self.layout_starts is None:
+            self.window_index()
+            self.layout_starts = np.searchsorted(
+                self.folder_index[:, 0], np.arange(len(self.folder_files))
+            )
+        return self.layout_starts
+
+    def __load_folder_id(self, file_id: int) -> t.Tensor:
+        # by position among all the sequences of the folder
+        if self.store is not None:
+            # a tiled store only reads the part of the frames inside the crop
+            return self.store.sequence(file_id, crop=self.crop)
+        return load_uint8(os.path.join(self.folder, self.folder_files[file_id]))
+
+    def __layout_batches(self, start: int):
+        batch = self.layout.batch(start, start + self.batch_size)
+        slot, out = self.buffer(tuple(batch.shape), batch.dtype)
+        yield slot, out.copy_(batch)
+
+    def __index_batches(self, rows):
+        if self.layout is not None:
+            # rows of a file are contiguous in the layout, from its first row
+            starts = self.__layout_starts()
+            rows = starts[self.file_ids[rows[:, 0]]] + rows[:, 1]
+            slot, out = self.buffer(
+                (len(rows), *self.layout.windows.shape[1:]), t.uint8
+            )
+            yield slot, self.layout.gather(rows, out=out)
+            return
+        # only the frames of each window are read, from the decoded files kept
+        # by the source or from the memory map
+        windows = tuple(
+            self.source.read(f, o, o + self.window_size, crop=self.crop)
+            for f, o in rows.tolist()
+        )
+        if any(w.dtype != t.uint8 for w in windows):
+            windows = tuple(w.long() for w in windows)
+        slot, out = self.buffer((len(windows), *windows[0].shape), windows[0].dtype)
+        yield slot, t.stack(windows, out=out)
+
+    def output(self, batch: t.Tensor) -> tuple[t.Tensor, t.Tensor]:
+        if self.layout is not None:
+            batch = self.decode(batch)
+            return batch[:, 0], batch[:, 1]
+        return to_layout(self.decode(batch), self.time_steps, self.merge_nodes)
+
+
+class TorchDataLoader(DeviceLoader):
+    # The same windows through torch.utils.data worker processes. Windows are
+    # read by the workers in the order of a WindowSampler and stay uint8 until
+    # they reach the device, where they are decoded like in DataLoader. Without
+    # a store, each worker reads whole groups of `files_in_flight` files, which
+    # it keeps decoded.
+    def __init__(
+        self,
+        batch_size: int,
+        folder: str,
+        device,
+        *,
+        time_steps: int = 4,
+        crop=None,
+        shuffle: bool = True,
+        merge_nodes: bool = False,
+        power: float = 1.0,
+        store: WindowStore = None,
+        files_in_flight: int = 8,
+        num_samples: int = None,
+        rain_weight: float = None,
+        rank: int = 0,
+        world_size: int = 1,
+        drop_last: bool = False,
+        seed: int = None,
+        num_workers: int = 4,
+        files: list[str] = None,
+    ):
+        self.decode = FrameDecoder(power, device)
+        self.power = self.decode.power
+        self.normalizing_max = self.decode.normalizing_max
+        self.data_folder = folder
+        self.merge_nodes = merge_nodes
+        self.crop = crop
+        self.time_steps = time_steps
+        folder_files = store.files if store is not None else list_sequence_files(folder)
+        ids = file_ids(folder_files, files)
+        if store is not None:
+            source = StoreSource(store, files=files)
         else:
-            result = result.permute(0, 1, 4, 5, 2, 3)
-        results = (
-            result[0][rand_indices],
-            result[1][rand_indices],
+            source = PtSource(
+                folder,
+                files=tuple(folder_files[i] for i in ids),
+                cache_size=files_in_flight,
+                load=load_uint8,
+            )
+        dataset = WindowDataset(source, 2 * time_steps, crop=crop)
+        weights = None
+        if rain_weight is not None:
+            # computed once for the whole folder, like in DataLoader
+            folder_index = load_window_index(
+                folder,
+                folder_files,
+                2 * time_steps,
+                lengths=None if store is None else np.diff(store.offsets).tolist(),
+            )
+            _, rows = select_files(folder_index, ids)
+            rain = window_rain_stats(
+                folder,
+                folder_files,
+                folder_index,
+                2 * time_steps,
+                time_steps,
+                crop=crop,
+            )
+            weights = 1 + rain_weight * (rain["x"][rows] + rain["y"][rows]) / 2
+            weights = t.from_numpy(weights)
+        sampler = WindowSampler(
+            dataset.index,
+            batch_size,
+            shuffle=shuffle,
+            files_in_flight=None if store is not None else files_in_flight,
+            num_samples=num_samples,
+            weights=weights,
+            seed=seed,
+            rank=rank,
+            world_size=world_size,
+            drop_last=drop_last,
+        )
+        super().__init__(
+            dataset if store is not None else SampledBatches(dataset, sampler),
+            batch_size,
+            device,
+            in_len=time_steps,
+            transform=self.__transform,
+            batch_sampler=sampler if store is not None else None,
+            num_workers=num_workers,
         )
-        return results
 
-    def __iter__(self):
-        return self
+    def __transform(self, batch: t.Tensor) -> t.Tensor:
+        frames = self.decode(batch)
+        if self.merge_nodes:
+            return merge_nodes(frames)
+        return frames.permute(0, 3, 4, 1, 2)
 
 
 def get_loaders(
@@ -138,31 +427,114 @@ def get_loaders(
     crop: int = None,
     shuffle: bool = True,
     merge_nodes: bool = False,
+    use_store: bool = False,
+    global_shuffle: bool = False,
+    rain_weight: float = None,
+    rank: int = 0,
+    world_size: int = 1,
+    use_layout: bool = False,
+    pyramid: bool = False,
+    torch_workers: int = 0,
+    split_scheme: str = None,
 ):
+    # splits are read from <data>/splits/<split_scheme>.json, "default" when it
+    # exists; datasets split in train/ and test/ folders are read as they are
+    if split_scheme is None and os.path.exists(split_path(data_folder, DEFAULT_SCHEME)):
+        split_scheme = DEFAULT_SCHEME
+    scheme = read_splits(data_folder, split_scheme) if split_scheme else None
+    if pyramid and crop is not None:
+        # the smallest pooled level whose frames still cover the crop
+        data_folder, _ = pick_level(data_folder, (crop, crop))
+    splits = {
+        split: {
+            "folder": scheme["folder"] if scheme else split,
+            "files": scheme["splits"][split] if scheme else None,
+            "split": f"{split_scheme}/{split}" if scheme else split,
+        }
+        for split in ("train", "test")
+    }
+    stores = {
+        split: open_store(data_folder, options["folder"], tile_size=crop)
+        if use_store
+        else None
+        for split, options in splits.items()
+    }
+    if torch_workers > 0:
+        # worker processes instead of threads; windows are always drawn through
+        # the window index, window layouts are only read by DataLoader
+        return tuple(
+            TorchDataLoader(
+                batch_size,
+                os.path.join(data_folder, splits[split]["folder"]),
+                device,
+                crop=crop,
+                shuffle=shuffle,
+                merge_nodes=merge_nodes,
+                store=stores[split],
+                rain_weight=rain_weight if split == "train" else None,
+                rank=rank if split == "train" else 0,
+                world_size=world_size if split == "train" else 1,
+                num_workers=torch_workers,
+                files=splits[split]["files"],
+            )
+            for split, batch_size in (
+                ("train", train_batch_size),
+                ("test", test_batch_size),
+                ("test", test_batch_size),
+            )
+        )
+    layouts = {
+        split: open_layout(
+            data_folder,
+            options["folder"],
+            crop=crop,
+            merged=merge_nodes,
+            store=stores[split],
+        )
+        if use_layout
+        else None
+        for split, options in splits.items()
+    }
+    # only the training split is sharded, every rank evaluates on all of test
     train_loader = DataLoader(
         train_batch_size,
-        os.path.join(data_folder, "train"),
+        os.path.join(data_folder, splits["train"]["folder"]),
         device,
         crop=crop,
         shuffle=shuffle,
         merge_nodes=merge_nodes,
+        store=stores["train"],
+        layout=layouts["train"],
+        global_shuffle=global_shuffle,
+        rain_weight=rain_weight,
+        rank=rank,
+        world_size=world_size,
+        files=splits["train"]["files"],
+        split=splits["train"]["split"],
     )
-
     val_loader = DataLoader(
         test_batch_size,
-        os.path.join(data_folder, "test"),
+        os.path.join(data_folder, splits["test"]["folder"]),
         device,
         crop=crop,
         shuffle=shuffle,
         merge_nodes=merge_nodes,
+        store=stores["test"],
+        layout=layouts["test"],
+        files=splits["test"]["files"],
+        split=splits["test"]["split"],
     )
     test_loader = DataLoader(
         test_batch_size,
-        os.path.join(data_folder, "test"),
+        os.path.join(data_folder, splits["test"]["folder"]),
         device,
         crop=crop,
         shuffle=shuffle,
         merge_nodes=merge_nodes,
+        store=stores["test"],
+        layout=layouts["test"],
+        files=splits["test"]["files"],
+        split=splits["test"]["split"],
     )
     return train_loader, val_loader, test_loader
 
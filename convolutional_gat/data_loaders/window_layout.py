@@ -0,0 +1,210 @@
+import os
+import json
+import numpy as np
+import torch as t
+from functools import lru_cache
+from tqdm import tqdm
+from sequence_data.files import atomic_write, file_lock, temp_path
+from sequence_data.window_index import load_window_index
+from sequence_data.window_store import WindowStore, frame_dtype, list_sequence_files
+from sequence_data.windows import sliding_windows, split_windows
+
+# A window layout holds every window of a split already in the layout the
+# models consume, so a batch is a slice of a memory map instead of a strided
+# gather followed by a permutation:
+#   windows.npy -> dtype of the frames (see window_store.frame_dtype), shape
+#                  (n_windows, 2, *sample_shape), [:, 0] is the input and
+#                  [:, 1] the target of the window; sample_shape is
+#                  (H, W, T, V), or (T, 2 * H, 3 * W) with merged nodes
+#   meta.json   -> source files, time steps, crop, merge_nodes; written last
+# Window i is row i of the window index of the split.
+
+
+def merge_nodes(data: t.Tensor) -> t.Tensor:
+    return t.cat(
+        tuple(t.cat((data[:, :, i], data[:, :, i + 1]), dim=2) for i in range(3)),
+        dim=3,
+    )
+
+
+def to_layout(
+    windows: t.Tensor, time_steps: int, merged: bool = False
+) -> tuple[t.Tensor, t.Tensor]:
+    # windows of shape (n, 2 * time_steps, V, H, W) as stored in the sequences
+    xs, ys = split_windows(windows, time_steps)
+    if merged:
+        return merge_nodes(xs), merge_nodes(ys)
+    return xs.permute(0, 3, 4, 1, 2), ys.permute(0, 3, 4, 1, 2)
+
+
+def layout_path(
+    data_folder: str, split: str, time_steps: int, crop: int = None, merged=False
+) -> str:
+    name = f"{'merged' if merged else 'native'}_{2 * time_steps}_{crop or 'full'}"
+    return os.path.join(data_folder, "layout", split, name)
+
+
+def _window_index(
+    folder: str, window_size: int, store: WindowStore = None
+) -> tuple[tuple[str, ...], np.ndarray]:
+    # the sequences of the split and their window index, which the rows of a
+    # layout follow
+    if store is not None:
+        files = store.files
+        lengths = np.diff(store.offsets).tolist()
+    else:
+        files = list_sequence_files(folder)
+        lengths = None
+    return files, load_window_index(folder, files, window_size, lengths=lengths)
+
+
+def build_layout(
+    folder: str,
+    out_folder: str,
+    *,
+    time_steps: int = 4,
+    crop: int = None,
+    merged: bool = False,
+    store: WindowStore = None,
+    block: int = 256,
+) -> "WindowLayout":
+    os.makedirs(out_folder, exist_ok=True)
+    window_size = 2 * time_steps
+    files, index = _window_index(folder, window_size, store)
+    # under a temporary name, a process may have the previous windows mapped
+    windows_path = os.path.join(out_folder, "windows.npy")
+    windows = None
+    row = 0
+    for file_id, fn in enumerate(tqdm(files, desc="Writing windows")):
+        if store is not None:
+            data = store.sequence(file_id, crop=crop)
+        else:
+            data = t.load(os.path.join(folder, fn))
+            if crop is not None:
+                data = data[..., :crop, :crop]
+        data = data[: (len(data) // window_size) * window_size]
+        dtype = frame_dtype(data.numpy().dtype)
+        if dtype != data.numpy().dtype:
+            assert data.min() >= 0 and data.max() <= 255, f"{fn} does not fit in uint8"
+            data = t.from_numpy(data.numpy().astype(dtype))
+        file_windows = sliding_windows(data, window_size)
+        if windows is None:
+            sample_shape = to_layout(file_windows[:1], time_steps, merged)[0].shape
+            windows = np.lib.format.open_memmap(
+                temp_path(windows_path),
+                dtype=dtype,
+                mode="w+",
+                shape=(len(index), 2, *sample_shape[1:]),
+            )
+        # in blocks of windows, to keep the permuted copies small
+        for start in range(0, len(file_windows), block):
+            xs, ys = to_layout(file_windows[start : start + block], time_steps, merged)
+            windows[row : row + len(xs), 0] = xs.numpy()
+            windows[row : row + len(xs), 1] = ys.numpy()
+            row += len(xs)
+    assert row == len(index), f"wrote {row} windows, the index has {len(index)}"
+    if windows is not None:
+        windows.flush()
+        del windows
+        os.replace(temp_path(windows_path), windows_path)
+    with atomic_write(os.path.join(out_folder, "meta.json")) as f:
+        json.dump(
+            {
+                "files": files,
+                "time_steps": time_steps,
+                "crop": crop,
+                "merge_nodes": merged,
+            },
+            f,
+        )
+    return WindowLayout(out_folder)
+
+
+class WindowLayout:
+    def __init__(self, folder: str):
+        self.folder = folder
+        with open(os.path.join(folder, "meta.json")) as f:
+            meta = json.load(f)
+        self.files = tuple(meta["files"])
+        self.time_steps = meta["time_steps"]
+        self.crop = meta["crop"]
+        self.merged = meta["merge_nodes"]
+        # copy-on-write, so torch gets a writable array without a copy
+        self.windows = np.load(os.path.join(folder, "windows.npy"), mmap_mode="c")
+
+    def __len__(self):
+        return len(self.windows)
+
+    def batch(self, start: int, stop: int) -> t.Tensor:
+        return t.from_numpy(self.windows[start:stop])
+
+    def gather(self, rows: np.ndarray, out: t.Tensor = None) -> t.Tensor:
+        # sorted reads, put back in the order of the rows
+        order = np.argsort(rows, kind="stable")
+        batch = t.from_numpy(self.windows[rows[order]])
+        inverse = t.from_numpy(np.argsort(order))
+        return t.index_select(batch, 0, inverse, out=out)
+
+
+@lru_cache(maxsize=None)
+def open_layout(
+    data_folder: str,
+    split: str,
+    *,
+    time_steps: int = 4,
+    crop: int = None,
+    merged: bool = False,
+    store: WindowStore = None,
+    build: bool = True,
+) -> WindowLayout:
+    path = layout_path(data_folder, split, time_steps, crop, merged)
+    if not build and not os.path.exists(os.path.join(path, "meta.json")):
+        raise FileNotFoundError(f"No window layout found at {path}")
+    # every rank opens the layout at startup, one of them writes it
+    with file_lock(path):
+        if os.path.exists(os.path.join(path, "meta.json")):
+            layout = WindowLayout(path)
+            # sequences added or extended since the layout was written make it
+            # stale, it is written again
+            files, index = _window_index(
+                os.path.join(data_folder, split), 2 * time_steps, store
+            )
+            if layout.files == files and len(layout) == len(index):
+                return layout
+            if not build:
+                raise FileNotFoundError(f"The window layout at {path} is out of date")
+            print(f"Rewriting the out of date window layout for {split} in {path}")
+        else:
+            print(f"Writing window layout for {split} in {path}")
+        return build_layout(
+            os.path.join(data_folder, split),
+            path,
+            time_steps=time_steps,
+            crop=crop,
+            merged=merged,
+            store=store,
+        )
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument("-d", "--data-folder", type=str)
+    parser.add_argument(
+        "-s", "--splits", type=str, nargs="+", default=["train", "test"]
+    )
+    parser.add_argument("-t", "--time-steps", type=int, default=4)
+    parser.add_argument("-c", "--crop", type=int, default=None)
+    parser.add_argument("--merge-nodes", action="store_true")
+    args = parser.parse_args()
+    for split in args.splits:
+        build_layout(
+            os.path.join(args.data_folder, split),
+            layout_path(
+                args.data_folder, split, args.time_steps, args.crop, args.merge_nodes
+            ),
+            time_steps=args.time_steps,
+            crop=args.crop,
+            merged=args.merge_nodes,
+        )
@@ -1,6 +1,7 @@
 from argparse import ArgumentParser
 import json
 from .preprocessing import preprocess
+from ..pyramid import build_pyramid
 
 
 def main():
@@ -12,13 +13,24 @@ def main():
         type=str,
         default='[["ASII", "asii_turb_trop_prob"]]',  # default='[["CRR", "crr"]]'
     )
+    # processes decoding the netCDF files
+    parser.add_argument("--num-workers", type=int, default=4)
+    # area pooled copies for low resolution runs, e.g. --pyramid-factors 2 4 8
+    parser.add_argument("--pyramid-factors", type=int, nargs="*", default=[])
     args = parser.parse_args()
     select_variables = tuple(
         (str(x[0]), str(x[1])) for x in json.loads(args.select_variables)
     )
     preprocess(
-        in_path=args.in_path, out_path=args.out_path, select_variables=select_variables,
+        in_path=args.in_path,
+        out_path=args.out_path,
+        select_variables=select_variables,
+        num_workers=args.num_workers,
     )
+    if len(args.pyramid_factors) > 0:
+        build_pyramid(
+            args.out_path, tuple(args.pyramid_factors), ["training", "validation"]
+        )
 
 
 if __name__ == "__main__":
@@ -1,5 +1,7 @@
 import json
 import os
+import shutil
+from concurrent.futures import Executor, ProcessPoolExecutor
 
 import ipdb
 import netCDF4
@@ -45,9 +47,17 @@ def get_time_from_file_name(file_name: str) -> int:
 
 
 def get_missing_mask(directory: str) -> tuple[str, ...]:
-    _, files = tuple(zip(*listdir(directory)))
-    files = sorted(files, key=get_time_from_file_name)
-    files_time_steps = tuple(get_time_from_file_name(fn) for fn in files)
+    return missing_mask(
+        [(fp, get_time_from_file_name(fn)) for fn, fp in listdir(directory)]
+    )
+
+
+def missing_mask(timed_files: list[tuple[str, int]]) -> tuple[str, ...]:
+    # the file of every quarter-hour of a day, "" where there is none, from
+    # (file, time) pairs
+    timed_files = sorted(timed_files, key=lambda timed_file: timed_file[1])
+    files = tuple(fn for fn, _ in timed_files)
+    files_time_steps = tuple(time for _, time in timed_files)
     all_time_steps = get_time_range()
     fixed_files: list[str] = []
     i = 0
@@ -61,7 +71,10 @@ def get_missing_mask(directory: str) -> tuple[str, ...]:
 
 
 def get_continuous_splits(directory: str) -> list[list[str]]:
-    files = get_missing_mask(directory)
+    return continuous_splits(get_missing_mask(directory))
+
+
+def continuous_splits(files: tuple[str, ...]) -> list[list[str]]:
     acc = [[]]
     for f in files:
         if f != "":
@@ -71,6 +84,46 @@ def get_continuous_splits(directory: str) -> list[list[str]]:
     return acc
 
 
+# The file index (file_index.json in the output folder, kept across runs)
+# lists the files of every <region>/<condition>/<day>/<variable> folder of the
+# raw data with their time, and the modification time of the folder. A run
+# only lists the folders that are new or were modified since the index was
+# written, continuity detection reads the index.
+
+
+def load_file_index(
+    in_path: str, index_path: str, folders: list[str]
+) -> dict[str, list[tuple[str, int]]]:
+    # the (file, time) pairs of each folder, relative to in_path
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+    changed = False
+    for folder in tqdm(folders, desc="Indexing files"):
+        mtime = os.stat(os.path.join(in_path, folder)).st_mtime_ns
+        if folder not in index or index[folder]["mtime"] != mtime:
+            index[folder] = {
+                "mtime": mtime,
+                "files": [
+                    (fn, get_time_from_file_name(fn))
+                    for fn in sorted(os.listdir(os.path.join(in_path, folder)))
+                ],
+            }
+            changed = True
+    if changed:
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(index_path + ".tmp", index_path)
+    return {
+        folder: [
+            (os.path.join(in_path, folder, fn), time)
+            for fn, time in index[folder]["files"]
+        ]
+        for folder in folders
+    }
+
+
 def nested_tensor_list_to_tensor(nested) -> t.Tensor:
     if len(nested) == 0:
         return t.tensor([])
@@ -131,46 +184,54 @@ def split_continuous_blocks_at_root(
     return new_accumulator
 
 
-def block_to_tensor(block: dict[str, dict[tuple[str, str], list[str]]]) -> t.Tensor:
-    accumulator = []
-    for _, var_acc in block.items():
-        region_accumulator = []
-        for var, block_files in var_acc.items():
-            files_accumulator = []
-            for file in block_files:
-                fc = netCDF4.Dataset(file)[var[1]]
-                masked_array = fc[...]
-                valid_range = fc.valid_range
-                """
-                print(
-                    f"{np.sum(masked_array.mask) / len(masked_array.mask.flatten())=}"
-                )
-                """
-                array = masked_array.filled(
-                    (np.max(valid_range) - np.min(valid_range)) / 2
-                )
-                scale_factor = fc.scale_factor if "scale_factor" in fc.__dict__ else 1
-                add_offset = fc.add_offset if "add_offset" in fc.__dict__ else 0
-                normalized_array = (
-                    (array / (np.max(valid_range) * scale_factor)) - add_offset
-                ).astype(np.float32)
-                # minv = np.min(fc)
-                # maxv = np.max(fc)
-                # if minv != 0 or maxv != 0:
-                """
-                print(f"{maxv=}")
-                print(f"{minv=}")
-                print(f"{np.max(normalized_array)=}")
-                print(f"{np.min(normalized_array)=}")
-                """
-                data = t.from_numpy(normalized_array)
-                files_accumulator.append(data)
-            tensorized_file_accumulator = t.stack(files_accumulator)
-            region_accumulator.append(tensorized_file_accumulator)
-        tensorized_region_accumulator = t.stack(region_accumulator)
-        accumulator.append(tensorized_region_accumulator)
-    tensorized_accumulator = t.stack(accumulator).permute(2, 0, 1, 3, 4)
-    return tensorized_accumulator
+def read_frame(file: str, variable: str) -> np.ndarray:
+    # one variable of a netCDF file, with the masked values filled and
+    # normalized; the file is closed before returning, so a pool of workers
+    # never holds more open files than it has workers
+    with netCDF4.Dataset(file) as dataset:
+        fc = dataset[variable]
+        masked_array = fc[...]
+        valid_range = fc.valid_range
+        scale_factor = getattr(fc, "scale_factor", 1)
+        add_offset = getattr(fc, "add_offset", 0)
+    low, high = np.min(valid_range), np.max(valid_range)
+    array = masked_array.filled((high - low) / 2)
+    return ((array / (high * scale_factor)) - add_offset).astype(np.float32)
+
+
+def block_to_tensor(
+    block: dict[str, dict[tuple[str, str], list[str]]], executor: Executor = None
+) -> t.Tensor:
+    # every frame is written straight to its place in a (time, region,
+    # variable, height, width) array, allocated once its frame size is known;
+    # files are decoded by the executor's workers when there is one
+    regions = list(block.values())
+    n_steps = {len(files) for var_acc in regions for files in var_acc.values()}
+    if len(n_steps) > 1:
+        raise ValueError(
+            f"the files of a block cover {sorted(n_steps)} time steps, all the"
+            " regions and variables should cover the same"
+        )
+    tasks = [
+        ((k, r, v), file, var[1])
+        for r, var_acc in enumerate(regions)
+        for v, (var, block_files) in enumerate(var_acc.items())
+        for k, file in enumerate(block_files)
+    ]
+    if len(tasks) == 0:
+        return t.tensor([])
+    positions, files, variables = zip(*tasks)
+    if executor is not None:
+        frames = executor.map(read_frame, files, variables, chunksize=16)
+    else:
+        frames = map(read_frame, files, variables)
+    out = None
+    for position, frame in zip(positions, frames):
+        if out is None:
+            shape = (n_steps.pop(), len(regions), len(regions[0]), *frame.shape)
+            out = np.empty(shape, dtype=np.float32)
+        out[position] = frame
+    return t.from_numpy(out)
 
 
 def preprocess(
@@ -180,10 +241,18 @@ def preprocess(
     in_path: str = "~/downloads/mai_dataset",
     out_path: str = "./preprocessed",
     select_variables: tuple[tuple[str, str], ...] = (("CRR", "crr"),),
+    num_workers: int = 4,
 ):
-    if os.path.exists(out_path):
-        os.system(f"rm -rf {out_path}")
-    os.mkdir(out_path)
+    # the output of earlier runs is removed, but not their file index
+    index_path = os.path.join(out_path, "file_index.json")
+    os.makedirs(out_path, exist_ok=True)
+    for fn, fp in listdir(out_path):
+        if fp == index_path:
+            continue
+        if os.path.isdir(fp) and not os.path.islink(fp):
+            shutil.rmtree(fp)
+        else:
+            os.remove(fp)
     print(f"{in_path=}")
     print(f"{out_path=}")
     log = Logger(verbose)
@@ -191,25 +260,40 @@ def preprocess(
     print(f"{n_regions=}")
     metadata = {"n_regions": n_regions}
     conditions = ["training", "validation"]
+    regions = listdir(in_path)
+    days = {
+        condition: sorted(
+            (d[0] for d in listdir(os.path.join(in_path, "R1", condition))), key=int,
+        )
+        for condition in conditions
+    }
+    # every folder is listed once, or not at all when the index is up to date
+    file_index = load_file_index(
+        in_path,
+        index_path,
+        [
+            os.path.join(region, condition, day, variable_folder)
+            for condition in conditions
+            for day in days[condition]
+            for region, _ in regions
+            for variable_folder, _ in select_variables
+        ],
+    )
     for condition in conditions:
         metadata[condition] = {"length": 0}
         log(f"Preprocessing {condition}")
         out_condition_path = os.path.join(out_path, condition)
         mkdir(out_condition_path)
-        days = sorted(
-            (d[0] for d in listdir(os.path.join(in_path, "R1", condition))), key=int,
-        )
         accumulator = {}
-        for day in tqdm(days):
-            for rel_region_path, region_path in listdir(in_path):
+        for day in tqdm(days[condition]):
+            for rel_region_path, region_path in regions:
                 if rel_region_path not in accumulator:
                     accumulator[rel_region_path] = {var: {} for var in select_variables}
                 region_accumulator = accumulator[rel_region_path]
                 for variable_folder, variable_name in select_variables:
-                    in_variable_path = os.path.join(
-                        region_path, condition, day, variable_folder
-                    )
-                    continuous_splits = get_continuous_splits(in_variable_path)
+                    files = file_index[
+                        os.path.join(rel_region_path, condition, day, variable_folder)
+                    ]
                     """
                     for rel_file_path, file_path in listdir(
                         in_variable_path
@@ -225,7 +309,7 @@ def preprocess(
                     """
                     region_accumulator[(variable_folder, variable_name)][
                         day
-                    ] = continuous_splits
+                    ] = continuous_splits(missing_mask(files))
             """
             tensorized_accumulator = (
                 nested_tensor_list_to_tensor(accumulator)
@@ -241,15 +325,17 @@ def preprocess(
             """
         continuous_blocks = split_continuous_blocks_at_root(merge_days(accumulator))
         print("Saving stuff")
-        for i, block in tqdm(tuple(enumerate(continuous_blocks))):
-            tensor_block = block_to_tensor(block)
-            if len(tensor_block) > 9:
-                file_name = os.path.join(out_condition_path, f"{i}.pt")
-                t.save(tensor_block, file_name)
-                metadata[condition]["length"] += len(tensor_block)
-            else:
-                print("Skipped tensor because it was too small")
-                print(len(tensor_block))
+        # netCDF is not thread-safe, files are decoded in worker processes
+        with ProcessPoolExecutor(num_workers) as executor:
+            for i, block in tqdm(tuple(enumerate(continuous_blocks))):
+                tensor_block = block_to_tensor(block, executor)
+                if len(tensor_block) > 9:
+                    file_name = os.path.join(out_condition_path, f"{i}.pt")
+                    t.save(tensor_block, file_name)
+                    metadata[condition]["length"] += len(tensor_block)
+                else:
+                    print("Skipped tensor because it was too small")
+                    print(len(tensor_block))
         print(f"Done {condition}")
     print("Writing metadata:")
     print(json.dumps(metadata, indent=4))
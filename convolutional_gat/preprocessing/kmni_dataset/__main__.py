@@ -5,12 +5,24 @@ from argparse import ArgumentParser
 # listdir is the same as same as os.listdir but it returns a list of tuples (file_name, absolute_file_name).
 # mkdir creates a folder only if it doesn't exist already
 from ..utils import listdir, mkdir
+from ..stats import split_stats
+from ..pyramid import FACTORS, build_pyramid
+from sequence_data.splits import (
+    DEFAULT_SCHEME,
+    block_split,
+    read_splits,
+    split_path,
+    write_splits,
+)
 import numpy as np
 import json
 import ipdb
 import matplotlib.pyplot as plt
 import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from tempfile import TemporaryDirectory
 
 # used only to display
 def draw_rectangle(img, x0, y0, width, height, border=3):  # not currently used
@@ -20,137 +32,477 @@ def draw_rectangle(img, x0, y0, width, height, border=3):  # not currently used
     img[x0 + border : x0 + width - border, y0 + border : y0 + height - border] = inner
 
 
-def get_z_score_normalizing_constants(preprecessed_folder: str):
-    acc = t.cat(
-        tuple(
-            t.load(fpath)
-            for fname, fpath in listdir(os.path.join(preprecessed_folder, "train"))
+def get_z_score_normalizing_constants(
+    preprecessed_folder: str, num_workers: int = 4, scheme: str = DEFAULT_SCHEME
+):
+    # streamed over the training sequences of the split scheme, writes the
+    # per-pixel mean and variance to metadata_<scheme>.pt and a summary
+    # (histogram, quantiles) to metadata.json; data preprocessed into train/
+    # and test/ folders, without schemes, uses train/ and metadata.pt
+    if not os.path.exists(split_path(preprecessed_folder, scheme)) and os.path.isdir(
+        os.path.join(preprecessed_folder, "train")
+    ):
+        summary = split_stats(preprecessed_folder, "train", num_workers)
+    else:
+        splits = read_splits(preprecessed_folder, scheme)
+        files = [
+            os.path.join(preprecessed_folder, splits["folder"], fn)
+            for fn in splits["splits"]["train"]
+        ]
+        summary = split_stats(
+            preprecessed_folder, f"{scheme}/train", num_workers, files
         )
-    ).float()
-    result = {
-        "mean": t.mean(acc, dim=0),
-        "var": t.var(acc, dim=0),
-    }
-    t.save(result, os.path.join(preprecessed_folder, "metadata.pt"))
+    summary = {key: val for key, val in summary.items() if key != "histogram"}
+    print(json.dumps(summary, indent=4))
 
 
-def preprocess(
-    in_dir: str, out_dir: str, from_year: int = 2016, rain_threshold: float = 0.2,
-):
-    out_dir = Path(out_dir) / "train"
+COORDINATES = (  # coordinates of areas of interest within the larger image
+    (201, 38),
+    (201 - 80, 81),
+    (201 - 80 + 4, 81 + 92),
+    (214, 140),
+    (29, 190),
+    (29 + 10, 186 - 85),
+)
 
-    # Careful here (imagine someone putting in an "important" folder such as "system32")
-    if os.path.exists(out_dir):
-        os.removedirs(out_dir)
-    os.makedirs(out_dir, exist_ok=True)
 
-    years = listdir(in_dir)
-    acc = []  # we will use it to store the continous frame of data (video)
-    coordinates = (  # coordinates of areas of interest within the larger image
-        (201, 38),
-        (201 - 80, 81),
-        (201 - 80 + 4, 81 + 92),
-        (214, 140),
-        (29, 190),
-        (29 + 10, 186 - 85),
-    )
-    file_index = 0
-    patience = True
+BOUNDING_BOX = np.s_[243:590, 234:512]  # contains every area of interest
+NODATA = 65535  # value of the pixels without data in the radar files
+DTYPES = ("uint8", "int16", "int32")  # dtypes a sequence can be stored as
+
+# pixel (row, column) indices of the areas of interest within the bounding
+# box, so that all of them are extracted with one gather
+_ROWS = np.array([x for x, _ in COORDINATES])[:, None, None] + np.arange(80)[:, None]
+_COLUMNS = np.array([y for _, y in COORDINATES])[:, None, None] + np.arange(80)
+
+
+def _month_frames(file_paths: list[str], frames_file: str, rain_threshold: float):
+    # the regions of radar files of a month, written to `frames_file` as read
+    # (uint16, NODATA included), whether each frame is rainy enough, and the
+    # max and min of the valid pixels
     max_val = 0
     min_val = 1000
+    rainy = []
+    if len(file_paths) == 0:
+        return rainy, max_val, min_val
+    frames = np.lib.format.open_memmap(
+        frames_file, mode="w+", dtype=np.uint16, shape=(len(file_paths), 6, 80, 80)
+    )
+    box = np.empty(tuple(sl.stop - sl.start for sl in BOUNDING_BOX), np.uint16)
+    threshold = np.float32(rain_threshold)
+    for k, file_path in enumerate(file_paths):
+        # only the bounding box is read from the file
+        with h5py.File(file_path, "r") as f:
+            f["image1"]["image_data"].read_direct(box, BOUNDING_BOX)
+        content = frames[k]
+        content[...] = box[_ROWS, _COLUMNS]
+        valid = content[content != NODATA]
+        if len(valid) > 0:
+            max_val = max(int(valid.max()), max_val)
+            min_val = min(int(valid.min()), min_val)
+        # NaNs count as dry pixels, computed in float32 as before
+        raininess = np.float32(1) - np.float32(
+            content.size - np.count_nonzero(valid)
+        ) / np.float32(content.size)
+        rainy.append(bool(raininess >= threshold))
+    frames.flush()
+    return rainy, max_val, min_val
+
+
+def split_sequences(
+    rainy_months: list[list[bool]], length: int = 0, patience: bool = True
+) -> tuple[list[tuple[int, int]], tuple[int, int, bool]]:
+    # (start, stop) of every sequence, as positions in the frames of all the
+    # months in order. A sequence goes on while frames are rainy; patience
+    # allows for one frame to not be enough rainy, this increases considerably
+    # the size of the dataset. Only sequences of at least 8 frames are kept,
+    # the minimum length we can make use of, and a sequence of more than 8
+    # frames is also closed at the end of a month.
+    # A sequence of `length` frames can be left open by a previous run, its
+    # frames are then the first positions. The sequence still open after the
+    # last frame is returned as (start, length, patience), before the end of
+    # its month, which may have more frames in a later run.
+    sequences = []
+    start = 0
+    position = length
+    for m, rainy_frames in enumerate(rainy_months):
+        if m > 0 and length > 8:  # end of the previous month
+            sequences.append((start, start + length))
+            length = 0
+        for rainy in rainy_frames:
+            if rainy or patience:
+                if length == 0:
+                    start = position
+                length += 1
+                patience = rainy
+            elif length >= 8:
+                sequences.append((start, start + length))
+                length = 0
+            else:  # if the size is too small, discard the data
+                length = 0
+            position += 1
+    return sequences, (start, length, patience)
+
+
+def _frame_parts(
+    frames_files: list[str], starts: np.ndarray, start: int, stop: int
+) -> list[tuple[str, int, int]]:
+    # frames start:stop can span several months, each part is a range of the
+    # frames of one month
+    parts = []
+    for frames_file, first, last in zip(frames_files, starts[:-1], starts[1:]):
+        lo, hi = max(start, first), min(stop, last)
+        if lo < hi:
+            parts.append((frames_file, lo - first, hi - first))
+    return parts
+
+
+def _read_frames(parts: list[tuple[str, int, int]]) -> np.ndarray:
+    return np.concatenate(
+        [np.load(frames_file, mmap_mode="r")[lo:hi] for frames_file, lo, hi in parts]
+        or [np.zeros((0, 6, 80, 80), dtype=np.uint16)]
+    )
+
+
+def _write_sequence(
+    file_name: str, mask_name: str, parts: list[tuple[str, int, int]], dtype: str
+):
+    frames = _read_frames(parts)
+    nodata = frames == NODATA
+    frames[nodata] = 0  # set NaNs to zero
+    t.save(t.from_numpy(frames.astype(dtype)), file_name)
+    # bit-packed along the width, 1/8 of a byte per pixel
+    np.save(mask_name, np.packbits(nodata, axis=-1))
+
+
+def nodata_mask(out_dir: str, name: str) -> t.Tensor:
+    # the pixels of sequence `name` that had no data, as a bool tensor of the
+    # shape of the sequence
+    packed = np.load(_nodata_path(Path(out_dir), name))
+    return t.from_numpy(np.unpackbits(packed, axis=-1, count=80).astype(bool))
+
+
+def _sequence_name(file_index: int) -> str:
+    return f'{str(file_index).rjust(10, "0")}.pt'
+
+
+def _nodata_path(out_dir: Path, name: str) -> Path:
+    # masks stay in one folder whatever the split of their sequence
+    return out_dir / "nodata" / name.replace(".pt", ".npy")
+
+
+def _sequence_path(out_dir: Path, name: str) -> Path:
+    # splits do not move sequences, see time_split
+    return out_dir / "sequences" / name
+
+
+def _source_key(rel_path: str) -> tuple[str, ...]:
+    # the order in which files are read: year, month, then file name
+    return tuple(rel_path.split("/"))
+
+
+# The manifest (manifest.json in the output folder) makes preprocessing
+# incremental:
+#   sources      -> every radar file consumed, in order, with the sequence it
+#                   went into (null when it was discarded or is still open)
+#   next_index   -> number of the next sequence
+#   open         -> the sequence left open by the last run: its source files,
+#                   patience, month, and the sequence it is already written as
+#                   when it was long enough to be closed at the end of the run;
+#                   its frames are kept in the file named by `checkpoint`
+#   checkpoint   -> file name of those frames, new for every run: the one the
+#                   manifest points to is only deleted once the new manifest
+#                   has replaced it
+#   max, min     -> of the valid pixels of all the files consumed
+#   dtype        -> of the sequences
+# A run only reads the files that are not in the manifest yet, and gives the
+# same sequences as a run over the whole archive would.
+# Sequences are stored as `dtype` with their NaNs set to zero; which pixels
+# were NaNs is kept in nodata/<sequence>.npy (see nodata_mask).
+
+
+def _empty_manifest(from_year: int, rain_threshold: float, dtype: str) -> dict:
+    return {
+        "from_year": from_year,
+        "rain_threshold": rain_threshold,
+        "dtype": dtype,
+        "sources": {},
+        "next_index": 0,
+        "open": {"files": [], "patience": True, "month": None, "written_as": None},
+        "max": 0,
+        "min": 1000,
+    }
+
+
+def _remove_checkpoints(out_dir: Path, keep: str = None):
+    # checkpoints of earlier runs, and of interrupted ones
+    for path in out_dir.glob("checkpoint*.npy"):
+        if path.name != keep:
+            os.remove(path)
+
+
+def _remove_outputs(out_dir: Path, manifest: dict):
+    # only what an earlier run wrote, never the whole folder
+    for name in set(manifest["sources"].values()) - {None}:
+        for path in (_sequence_path(out_dir, name), _nodata_path(out_dir, name)):
+            if os.path.exists(path):
+                os.remove(path)
+    for fn in ("manifest.json", "sequences/metadata.json"):
+        if os.path.exists(out_dir / fn):
+            os.remove(out_dir / fn)
+    _remove_checkpoints(out_dir)
+
+
+def preprocess(
+    in_dir: str,
+    out_dir: str,
+    from_year: int = 2016,
+    rain_threshold: float = 0.2,
+    num_workers: int = 4,
+    rebuild: bool = False,
+    dtype: str = "uint8",
+) -> list[str]:
+    # returns the names of the sequences added by this run
+    out_dir = Path(out_dir)
+    manifest_path = out_dir / "manifest.json"
+    manifest = None
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if rebuild:
+            _remove_outputs(out_dir, manifest)
+            manifest = None
+        elif (
+            manifest["from_year"],
+            manifest["rain_threshold"],
+            manifest.get("dtype", "int64"),
+        ) != (from_year, rain_threshold, dtype):
+            raise ValueError(
+                f"{out_dir} was preprocessed with from_year={manifest['from_year']},"
+                f" rain_threshold={manifest['rain_threshold']} and"
+                f" dtype={manifest.get('dtype', 'int64')}, pass --rebuild to"
+                " preprocess it again with other options"
+            )
+    if manifest is None:
+        # Careful here (imagine someone putting in an "important" folder such
+        # as "system32"): only the folders preprocessing writes are cleared,
+        # which an interrupted first run can leave behind
+        for folder in ("sequences", "nodata"):
+            if os.path.exists(out_dir / folder):
+                shutil.rmtree(out_dir / folder)
+        _remove_checkpoints(out_dir)
+        manifest = _empty_manifest(from_year, rain_threshold, dtype)
+    os.makedirs(out_dir / "sequences", exist_ok=True)
+    os.makedirs(out_dir / "nodata", exist_ok=True)
+
+    years = listdir(in_dir)
     if from_year != -1:
         index = [y[0] for y in years].index(str(from_year))
         years = years[index:]
+    consumed = manifest["sources"]
+    last = max((_source_key(fn) for fn in consumed), default=None)
+    months = {}
     for year, abs_path in years:
-        print(f"Year: {year}")
-        months = listdir(abs_path)
-        for month, month_path in months:
-            print(f"\t{month}")
-            days = [
-                (fname, fpath)
-                for fname, fpath in listdir(month_path)
-                if fname.endswith(".h5")
-            ]
-            for file, file_path in days:
-                raw_content = t.from_numpy(
-                    h5py.File(file_path)["image1"]["image_data"][...].astype(np.int64)
-                    # .astype(  # read file, we keep it a uint8 to save memory
-                    #    np.uint8
-                    # )
-                )
-                max_val = max(t.max(raw_content).item(), max_val)
-                min_val = min(t.min(raw_content).item(), min_val)
-                raw_content = raw_content[243:590, 234:512]  # subsample the image
-
-                # List comprehension is faster most of the time
-                content_accumulator = [
-                    raw_content[x : x + 80, y : y + 80] for x, y in coordinates
-                ]
-                content = t.stack(content_accumulator)  # merge them into one tensor
-                content[content == 65535] = 0  # set NaNs to zero
-                raininess = (
-                    1 - t.sum(content == 0) / content.numel()
-                )  # compute raininess of single image
-                if raininess >= rain_threshold:
-                    acc.append(content)
-                    patience = True
-                elif (
-                    patience
-                ):  # patience allows for one frame to not be enough rainy, this increases considerably the size of the dataset
-                    acc.append(content)
-                    patience = False
-                elif (
-                    len(acc) >= 8
-                ):  # select the continuous 'video' only if its length is 8, this is the minimum length we can make use of
-                    tensorized_acc = t.stack(acc)
-                    file_name = os.path.join(
-                        out_dir, f'{str(file_index).rjust(10, "0")}.pt'
+        for month, month_path in listdir(abs_path):
+            for fname, fpath in listdir(month_path):
+                rel_path = f"{year}/{month}/{fname}"
+                if not fname.endswith(".h5") or rel_path in consumed:
+                    continue
+                if last is not None and _source_key(rel_path) < last:
+                    raise ValueError(
+                        f"{rel_path} is older than the files already preprocessed,"
+                        " pass --rebuild to preprocess the archive again"
                     )
-                    acc = []
-                    t.save(tensorized_acc, file_name)
-                    file_index += 1
-                else:  # if the size is too small, discard the data
-                    acc = []
-            if len(acc) > 8:
-                tensorized_acc = t.stack(acc)
-                file_name = os.path.join(
-                    out_dir, f'{str(file_index).rjust(10, "0")}.pt'
-                )
-                acc = []
-                t.save(tensorized_acc, file_name)
-                file_index += 1
-    with open(os.path.join(out_dir, "metadata.json"), "w") as f:
-        json.dump({"max": max_val, "min": min_val}, f)
-
-
-def test_split(out_dir: str, ratio=0.2):
-    train_out_dir = os.path.join(out_dir, "train")
-    test_out_dir = os.path.join(out_dir, "test")
-    mkdir(test_out_dir)
-    files = listdir(train_out_dir)
-    randperm = t.randperm(len(files))
-    test_indices = randperm[: int(len(files) * ratio)]
-    for i in test_indices:
-        file_name, file_path = files[i]
-        os.system(f"mv {file_path} {os.path.join(test_out_dir,file_name)}")
+                months.setdefault(f"{year}/{month}", []).append((rel_path, fpath))
+    if len(months) == 0:
+        print("Nothing new to preprocess")
+        return []
+    open_seq = manifest["open"]
+    if open_seq["month"] is not None and open_seq["month"] not in months:
+        # the month of the open sequence is over, there are files in later ones
+        months = {open_seq["month"]: [], **months}
+    month_names = list(months)
+    n_open = len(open_seq["files"])
+
+    # months are read in parallel, each into its own temporary frames file,
+    # then split into sequences in order, exactly like a serial pass would;
+    # the frames of the open sequence come first
+    tmp_dir = TemporaryDirectory(dir=out_dir)
+    old_checkpoint = manifest.get("checkpoint", "checkpoint.npy")
+    frames_files = [str(out_dir / old_checkpoint)] + [
+        os.path.join(tmp_dir.name, f"{k}.npy") for k in range(len(months))
+    ]
+    with tmp_dir, ProcessPoolExecutor(num_workers) as executor:
+        results = executor.map(
+            _month_frames,
+            [[fpath for _, fpath in months[name]] for name in month_names],
+            frames_files[1:],
+            [rain_threshold] * len(months),
+        )
+        rainy_months = []
+        for name, (rainy, month_max, month_min) in zip(month_names, results):
+            print(f"{name}: {len(rainy)} frames")
+            rainy_months.append(rainy)
+            manifest["max"] = max(month_max, manifest["max"])
+            manifest["min"] = min(month_min, manifest["min"])
+        if manifest["max"] > np.iinfo(dtype).max:
+            raise ValueError(
+                f"values up to {manifest['max']} do not fit in {dtype}, pass a wider"
+                " dtype with --rebuild"
+            )
+        starts = np.cumsum([0, n_open] + [len(rainy) for rainy in rainy_months])
+        sources = open_seq["files"] + [
+            rel_path for name in month_names for rel_path, _ in months[name]
+        ]
+        for rel_path in sources[n_open:]:
+            consumed[rel_path] = None
+        sequences, (start, length, patience) = split_sequences(
+            rainy_months, n_open, open_seq["patience"]
+        )
+        if length > 8:
+            # closed now as at the end of its month, and reopened if the month
+            # goes on in a later run
+            sequences.append((start, start + length))
+        # the open sequence keeps its number when it was already written
+        next_index = manifest["next_index"]
+        first_index = next_index
+        if open_seq["written_as"] is not None:
+            first_index -= 1
+        names, file_names, mask_names, parts = [], [], [], []
+        for k, (seq_start, seq_stop) in enumerate(sequences):
+            name = _sequence_name(first_index + k)
+            for rel_path in sources[seq_start:seq_stop]:
+                consumed[rel_path] = name
+            if name == open_seq["written_as"] and seq_stop == n_open:
+                continue  # unchanged
+            names.append(name)
+            file_names.append(_sequence_path(out_dir, name))
+            mask_names.append(_nodata_path(out_dir, name))
+            parts.append(_frame_parts(frames_files, starts, seq_start, seq_stop))
+        list(
+            executor.map(
+                _write_sequence, file_names, mask_names, parts, [dtype] * len(parts)
+            )
+        )
+        # the frames of the sequence left open, for the next run, next to the
+        # checkpoint of the manifest until the new manifest is written
+        manifest["checkpoint"] = f"checkpoint_{len(consumed)}.npy"
+        np.save(
+            out_dir / manifest["checkpoint"],
+            _read_frames(_frame_parts(frames_files, starts, start, start + length)),
+        )
+    manifest["next_index"] = first_index + len(sequences)
+    manifest["open"] = {
+        "files": sources[start : start + length],
+        "patience": patience,
+        "month": month_names[-1],
+        "written_as": (
+            _sequence_name(manifest["next_index"] - 1) if length > 8 else None
+        ),
+    }
+    with open(out_dir / "sequences" / "metadata.json", "w") as f:
+        json.dump({"max": manifest["max"], "min": manifest["min"]}, f)
+    # written last, so an interrupted run is simply run again
+    with open(str(manifest_path) + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(str(manifest_path) + ".tmp", manifest_path)
+    _remove_checkpoints(out_dir, keep=manifest["checkpoint"])
+    return [name for name in names if name >= _sequence_name(next_index)]
+
+
+def time_split(
+    out_dir: str, name: str = DEFAULT_SCHEME, ratio: float = 0.2, seed: int = 0
+) -> dict[str, list[str]]:
+    # writes the split scheme `name` (see sequence_data/splits.py), where a
+    # share `ratio` of the months of sequences, at least one, goes to test; a
+    # sequence belongs to the month of its first frame. Sequences are not
+    # moved, and nearly all of those already split keep their split when the
+    # scheme is drawn again after preprocessing new files.
+    manifest_path = os.path.join(out_dir, "manifest.json")
+    if not os.path.exists(manifest_path):
+        # sequences of the older layout, in train/ and test/, are only numbered:
+        # the months they come from are unknown
+        raise FileNotFoundError(
+            f"{out_dir} has no manifest.json, it was preprocessed before split "
+            "schemes existed and its sequences cannot be split again; run "
+            "preprocess on the radar archive to write them in the current layout"
+        )
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    first = {}
+    for rel_path, sequence in manifest["sources"].items():
+        if sequence is not None:
+            first[sequence] = min(
+                first.get(sequence, rel_path), rel_path, key=_source_key
+            )
+    names = sorted(first)
+    months = ["/".join(_source_key(first[sequence])[:2]) for sequence in names]
+    splits = block_split(names, months, ratio, seed)
+    write_splits(
+        out_dir,
+        name,
+        splits,
+        folder="sequences",
+        options={"block": "month", "ratio": ratio, "seed": seed},
+    )
+    return splits
 
 
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument(
-        "action", choices=("preprocess", "test-split", "minimize", "z-score")
+        "action",
+        choices=("preprocess", "test-split", "minimize", "z-score", "pyramid"),
     )
     parser.add_argument("-i", "--in-dir", type=str)
     parser.add_argument("-o", "--out-dir", type=str)
     parser.add_argument("-r", "--rain-threshold", type=float, default=0.5)
     parser.add_argument("-y", "--from-year", type=int, default=2016)
+    parser.add_argument("-w", "--num-workers", type=int, default=4)
+    parser.add_argument(
+        "-s",
+        "--split-scheme",
+        type=str,
+        default=DEFAULT_SCHEME,
+        help="name of the split scheme written by preprocess and test-split",
+    )
+    parser.add_argument("--test-ratio", type=float, default=0.2)
+    parser.add_argument("--split-seed", type=int, default=0)
+    parser.add_argument(
+        "--dtype",
+        choices=DTYPES,
+        default="uint8",
+        help="dtype of the sequences, wider ones are needed for values over 255",
+    )
+    parser.add_argument("-f", "--pyramid-factors", type=int, nargs="+", default=FACTORS)
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="preprocess the whole archive again instead of only the new files",
+    )
     args = parser.parse_args()
     assert args.rain_threshold <= 1, "--rain-threshold must be <= 1"
     print(json.dumps(args.__dict__, indent=4))
     if args.action == "preprocess":
-        preprocess(args.in_dir, args.out_dir, args.from_year, args.rain_threshold)
-        test_split(args.out_dir)
+        preprocess(
+            args.in_dir,
+            args.out_dir,
+            args.from_year,
+            args.rain_threshold,
+            args.num_workers,
+            args.rebuild,
+            args.dtype,
+        )
+        # sequences of earlier runs keep their split
+        time_split(args.out_dir, args.split_scheme, args.test_ratio, args.split_seed)
     elif args.action == "test-split":
-        test_split(args.out_dir)
+        splits = time_split(
+            args.out_dir, args.split_scheme, args.test_ratio, args.split_seed
+        )
+        print({split: len(names) for split, names in splits.items()})
     elif args.action == "z-score":
-        get_z_score_normalizing_constants(args.out_dir)
+        get_z_score_normalizing_constants(
+            args.out_dir, args.num_workers, args.split_scheme
+        )
+    elif args.action == "pyramid":
+        build_pyramid(args.out_dir, tuple(args.pyramid_factors))
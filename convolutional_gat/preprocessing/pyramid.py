@@ -0,0 +1,108 @@
+import os
+import json
+import shutil
+import torch as t
+import torch.nn.functional as F
+from tqdm import tqdm
+from .utils import listdir
+
+# Downsampled copies of a preprocessed dataset, one per factor, written to
+# <data>/levels/x<factor> with the same splits, file names and metadata.json
+# as <data>, so a loader can be pointed at a level like at the full dataset.
+# Frames are area pooled (mean over factor x factor blocks), so a level covers
+# the whole region at a lower resolution; integer data is rounded back to its
+# dtype. When the frame size is not a multiple of the factor, the last partial
+# block is dropped.
+
+FACTORS = (2, 4, 8)
+
+
+def level_folder(data_folder: str, factor: int) -> str:
+    if factor == 1:
+        return data_folder
+    return os.path.join(data_folder, "levels", f"x{factor}")
+
+
+def area_pool(data: t.Tensor, factor: int) -> t.Tensor:
+    *lead, height, width = data.shape
+    pooled = F.avg_pool2d(data.reshape(-1, 1, height, width).float(), factor)
+    pooled = pooled.reshape(*lead, *pooled.shape[-2:])
+    if not data.is_floating_point():
+        pooled = pooled.round()
+    return pooled.to(data.dtype)
+
+
+def _split_folders(data_folder: str) -> list[str]:
+    # every folder of <data> holding sequences is a split
+    return [
+        fn
+        for fn, fp in listdir(data_folder)
+        if os.path.isdir(fp) and any(f.endswith(".pt") for f in os.listdir(fp))
+    ]
+
+
+def build_pyramid(
+    data_folder: str, factors: tuple[int, ...] = FACTORS, splits: list[str] = None
+):
+    factors = tuple(sorted(factors))
+    assert all(
+        b % a == 0 for a, b in zip((1, *factors), factors)
+    ), f"each factor must be a multiple of the previous one, got {factors}"
+    splits = _split_folders(data_folder) if splits is None else splits
+    frame_shape = None
+    for split in splits:
+        for factor in factors:
+            os.makedirs(
+                os.path.join(level_folder(data_folder, factor), split), exist_ok=True
+            )
+        for fn, fp in tqdm(listdir(os.path.join(data_folder, split)), desc=split):
+            if not fn.endswith(".pt"):
+                continue
+            data = t.load(fp)
+            frame_shape = list(data.shape[-2:])
+            # each level is pooled from the previous one, kept in float so that
+            # rounding errors do not add up across levels
+            pooled, previous = data.float(), 1
+            for factor in factors:
+                pooled = area_pool(pooled, factor // previous)
+                previous = factor
+                out = pooled.round() if not data.is_floating_point() else pooled
+                t.save(
+                    out.to(data.dtype),
+                    os.path.join(level_folder(data_folder, factor), split, fn),
+                )
+    if os.path.exists(os.path.join(data_folder, "metadata.json")):
+        for factor in factors:
+            shutil.copy(
+                os.path.join(data_folder, "metadata.json"),
+                os.path.join(level_folder(data_folder, factor), "metadata.json"),
+            )
+    os.makedirs(os.path.join(data_folder, "levels"), exist_ok=True)
+    with open(os.path.join(data_folder, "levels", "meta.json"), "w") as f:
+        json.dump({"factors": factors, "frame_shape": frame_shape}, f)
+
+
+def pick_level(data_folder: str, size: tuple[int, int]) -> tuple[str, int]:
+    # the smallest level that still has frames of at least `size`
+    meta_path = os.path.join(data_folder, "levels", "meta.json")
+    if not os.path.exists(meta_path):
+        return data_folder, 1
+    with open(meta_path) as f:
+        meta = json.load(f)
+    height, width = meta["frame_shape"]
+    factor = 1
+    for candidate in meta["factors"]:
+        if height // candidate >= size[0] and width // candidate >= size[1]:
+            factor = candidate
+    return level_folder(data_folder, factor), factor
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument("-d", "--data-folder", type=str)
+    parser.add_argument("-f", "--factors", type=int, nargs="+", default=FACTORS)
+    parser.add_argument("-s", "--splits", type=str, nargs="+", default=None)
+    args = parser.parse_args()
+    build_pyramid(args.data_folder, tuple(args.factors), args.splits)
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch as t
+from sequence_data.files import atomic_write, file_lock
+from .utils import listdir
+
+# Dataset statistics computed one sequence at a time, so memory stays bounded
+# by the largest sequence whatever the size of the archive. Partial results of
+# parallel workers are merged exactly: per-pixel mean and variance with the
+# pairwise update of Chan et al., histograms by addition.
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class StreamingStats:
+    def __init__(self):
+        self.count = 0  # number of frames
+        self.mean = None  # per-pixel, float64
+        self.m2 = None  # per-pixel sum of squared deviations
+        self.histogram = None  # counts per integer value, None for float data
+        self.min = None
+        self.max = None
+
+    def update(self, data: t.Tensor):
+        if len(data) == 0:
+            return
+        batch = StreamingStats()
+        frames = data.double()
+        mean = frames.mean(dim=0)
+        batch.count = len(data)
+        batch.mean = mean.numpy()
+        batch.m2 = ((frames - mean) ** 2).sum(dim=0).numpy()
+        batch.min = data.min().item()
+        batch.max = data.max().item()
+        if not data.is_floating_point() and batch.min >= 0:
+            batch.histogram = np.bincount(data.reshape(-1).numpy())
+        self.merge(batch)
+
+    def merge(self, other: "StreamingStats"):
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.__dict__.update(other.__dict__)
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / count)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * (self.count * other.count / count)
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        if self.histogram is None or other.histogram is None:
+            self.histogram = None
+        else:
+            size = max(len(self.histogram), len(other.histogram))
+            self.histogram = np.pad(self.histogram, (0, size - len(self.histogram)))
+            self.histogram += np.pad(other.histogram, (0, size - len(other.histogram)))
+
+    def var(self) -> np.ndarray:
+        # unbiased, like t.var
+        return self.m2 / max(self.count - 1, 1)
+
+    def quantiles(self, qs=QUANTILES) -> dict[str, int]:
+        if self.histogram is None:
+            return {}
+        cdf = np.cumsum(self.histogram)
+        return {
+            str(q): int(np.searchsorted(cdf, q * cdf[-1], side="left")) for q in qs
+        }
+
+    def summary(self) -> dict:
+        if self.count == 0:
+            return {"frames": 0}
+        # mean and variance over all pixels, from the per-pixel moments
+        mean = self.mean.mean()
+        squares = self.m2.sum() + self.count * ((self.mean - mean) ** 2).sum()
+        return {
+            "frames": self.count,
+            "min": self.min,
+            "max": self.max,
+            "mean": float(mean),
+            "var": float(squares / max(self.count * self.mean.size - 1, 1)),
+            "quantiles": self.quantiles(),
+            "histogram": None if self.histogram is None else self.histogram.tolist(),
+        }
+
+
+def _partial_stats(files: list[str]) -> StreamingStats:
+    stats = StreamingStats()
+    for file in files:
+        stats.update(t.load(file))
+    return stats
+
+
+def compute_stats(files: list[str], num_workers: int = 4) -> StreamingStats:
+    # contiguous chunks merged in order, so the result does not depend on
+    # which worker finishes first
+    n_chunks = max(min(num_workers, len(files)), 1)
+    chunks = [list(chunk) for chunk in np.array_split(np.array(files), n_chunks)]
+    stats = StreamingStats()
+    if num_workers <= 1:
+        partials = map(_partial_stats, chunks)
+    else:
+        with ProcessPoolExecutor(num_workers) as executor:
+            partials = list(executor.map(_partial_stats, chunks))
+    for partial in partials:
+        stats.merge(partial)
+    return stats
+
+
+def _fingerprint(files: list[str]) -> str:
+    # with the sizes, so that sequences extended in place are noticed
+    return hashlib.md5(
+        "\n".join(f"{fp}:{os.path.getsize(fp)}" for fp in sorted(files)).encode()
+    ).hexdigest()
+
+
+def split_stats(
+    data_folder: str,
+    split: str = "train",
+    num_workers: int = 4,
+    files: list[str] = None,
+) -> dict:
+    # summaries are cached in <data_folder>/metadata.json, per-pixel moments in
+    # <data_folder>/metadata.pt; both are recomputed when the split changes.
+    # `files` are the sequences of a split of a scheme (see
+    # sequence_data/splits.py), named <scheme>/<split>, instead of the
+    # sequences of the <data_folder>/<split> folder
+    if files is None:
+        files = [
+            fp
+            for fn, fp in listdir(os.path.join(data_folder, split))
+            if fn.endswith(".pt")
+        ]
+    scheme, _, name = split.rpartition("/")
+    metadata_path = os.path.join(data_folder, "metadata.json")
+    moments_path = os.path.join(
+        data_folder, f"metadata_{scheme}.pt" if scheme else "metadata.pt"
+    )
+
+    def read_cache() -> tuple[dict, dict]:
+        metadata = {}
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as f:
+                metadata = json.load(f)
+        cached = metadata.get("stats", {}).get(split)
+        if (
+            cached is not None
+            and cached["fingerprint"] == _fingerprint(files)
+            and (name != "train" or os.path.exists(moments_path))
+        ):
+            return metadata, cached
+        return metadata, None
+
+    _, cached = read_cache()
+    if cached is not None:
+        return cached
+    # every rank asks for the statistics at startup, one of them computes them
+    with file_lock(metadata_path):
+        metadata, cached = read_cache()
+        if cached is not None:
+            return cached
+        stats = compute_stats(files, num_workers)
+        if name == "train" and stats.count == 0:
+            # the normalizing moments of an empty split are undefined
+            raise ValueError(
+                f"The {split} split of {data_folder} has no frames "
+                f"({len(files)} sequences), cannot compute normalizing constants"
+            )
+        summary = {"fingerprint": _fingerprint(files), **stats.summary()}
+        metadata.setdefault("stats", {})[split] = summary
+        # the moments first, metadata.json only records them once they exist
+        if name == "train":
+            with atomic_write(moments_path, "wb") as f:
+                t.save(
+                    {
+                        "mean": t.from_numpy(stats.mean).float(),
+                        "var": t.from_numpy(stats.var()).float(),
+                    },
+                    f,
+                )
+        with atomic_write(metadata_path) as f:
+            json.dump(metadata, f)
+    return summary
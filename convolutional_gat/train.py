@@ -97,24 +97,15 @@ def train_single_epoch(
     criterion,
     scheduler,
     model,
-    train_batch_size,
-    test_batch_size,
-    preprocessed_folder,
+    train_loader,
+    val_loader,
     device,
-    dataset,
-    downsample_size,
     history,
     output_path,
 ):
-    train_loader, val_loader, test_loader = get_loaders(
-        train_batch_size=train_batch_size,
-        test_batch_size=test_batch_size,
-        preprocessed_folder=preprocessed_folder,
-        device=device,
-        dataset=dataset,
-        downsample_size=downsample_size,
-        merge_nodes=False,
-    )
+    # the loaders are built once, every epoch only reshuffles them
+    train_loader.set_epoch(epoch)
+    val_loader.set_epoch(epoch)
     model.train()
     print(f"\nEpoch: {epoch}")
     running_loss = t.tensor(0.0)
@@ -140,6 +131,8 @@ def train_single_epoch(
     # print(f"{__total_length=}")
     train_loss = (running_loss / total_length).item()
     print(f"Train loss: {round(train_loss, 6)}")
+    # a high starved fraction means training is waiting on the input pipeline
+    print(f"Input pipeline: {json.dumps(train_loader.queue_stats())}")
     history["train_loss"].append(train_loss)
     test_result = test(model, device, val_loader)
     scheduler.step(test_result["val_loss"])
@@ -174,6 +167,7 @@ def train(
     dataset="kmni",
     test_first=False,
     reduce_lr_on_plateau=False,
+    torch_workers=0,
 ):
     device = t.device("cuda" if t.cuda.is_available() else "cpu")
     history = {"train_loss": []}
@@ -187,6 +181,8 @@ def train(
         dataset=dataset,
         downsample_size=downsample_size,
         merge_nodes=merge_nodes,
+        # > 0 reads the data in torch.utils.data worker processes
+        torch_workers=torch_workers,
     )
     for x, y in val_loader:
         if not merge_nodes:
@@ -234,12 +230,9 @@ def train(
             criterion,
             scheduler,
             model,
-            train_batch_size,
-            test_batch_size,
-            preprocessed_folder,
+            train_loader,
+            val_loader,
             device,
-            dataset,
-            downsample_size,
             history,
             output_path,
         )
@@ -250,6 +243,7 @@ def train(
             downsample_size=downsample_size,
             preprocessed_folder=preprocessed_folder,
             dataset=dataset,
+            loader=val_loader,
         )
         plot_history(
             history,
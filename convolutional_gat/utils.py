@@ -46,6 +46,25 @@ def term_display(y, y_hat):
     print(climage.convert("/tmp/im1.png", is_unicode=True,))
 
 
+def find_rainy(loader, threshold: float = 0.5, part: str = "x", n: int = 1):
+    # returns a batch and the positions in it of up to n windows at least
+    # `threshold` rainy, looked up in the window index when the loader has one
+    # and found by scanning the batches otherwise
+    if hasattr(loader, "find_rainy"):
+        found = loader.find_rainy(threshold, part=part, n=n)
+        return None if found is None else (*found, list(range(len(found[0]))))
+    for x, y in loader:
+        data = x if part == "x" else y
+        rainy = [
+            k
+            for k in range(len(data))
+            if t.sum(data[k] > 0.0) / data[k].numel() >= threshold
+        ]
+        if len(rainy) > 0:
+            return x, y, rainy[:n]
+    return None
+
+
 def visualize_predictions(
     model,
     epoch=1,
@@ -53,53 +72,55 @@ def visualize_predictions(
     downsample_size=(256, 256),
     preprocessed_folder: str = "",
     dataset="kmni",
+    loader=None,
 ):
     plt.clf()
     with t.no_grad():
         device = t.device("cuda" if t.cuda.is_available() else "cpu")
-        train_loader, test_loader, _ = get_loaders(
-            train_batch_size=2,
-            test_batch_size=2,
-            preprocessed_folder=preprocessed_folder,
-            device=device,
-            downsample_size=downsample_size,
-            dataset=dataset,
-            merge_nodes=False,
-            shuffle=True,
-        )
+        if loader is not None:
+            test_loader = loader
+        else:
+            train_loader, test_loader, _ = get_loaders(
+                train_batch_size=2,
+                test_batch_size=2,
+                preprocessed_folder=preprocessed_folder,
+                device=device,
+                downsample_size=downsample_size,
+                dataset=dataset,
+                merge_nodes=False,
+                shuffle=True,
+            )
         model.eval()
         N_COLS = 4  # frames
         N_ROWS = 3  # x, y, preds
         plt.title(f"Epoch {epoch}")
         _fig, ax = plt.subplots(nrows=N_ROWS, ncols=N_COLS)
-        for x, y in test_loader:
-            for k in range(len(x)):
-                raininess = t.sum(x[k] > 0.0) / t.prod(t.tensor(x[k].shape))
-                if raininess >= 0.5:
-                    preds = model(x)
-                    to_plot = [
-                        t.pow(val, 1 / test_loader.power)
-                        for val in [x[k], y[k], preds[k]]
-                    ]
-                    for i, row in enumerate(ax):
-                        for j, col in enumerate(row):
-                            # ipdb.set_trace()
-                            col.imshow(to_plot[i].cpu().detach().numpy()[:, :, j, 1])
-
-                    row_labels = ["x", "y", "preds"]
-                    for ax_, row in zip(ax[:, 0], row_labels):
-                        ax_.set_ylabel(row)
-
-                    col_labels = ["frame1", "frame2", "frame3", "frame4"]
-                    for ax_, col in zip(ax[0, :], col_labels):
-                        ax_.set_title(col)
-
-                    save_path = os.path.join(path, f"pred_{epoch}.png")
-                    plt.savefig(save_path)
-                    plt.close()
-                    model.train()
-                    # term_display(y, preds)
-                    return
+        found = find_rainy(test_loader, 0.5)
+        if found is not None:
+            x, y, (k,) = found
+            preds = model(x)
+            to_plot = [
+                t.pow(val, 1 / test_loader.power) for val in [x[k], y[k], preds[k]]
+            ]
+            for i, row in enumerate(ax):
+                for j, col in enumerate(row):
+                    # ipdb.set_trace()
+                    col.imshow(to_plot[i].cpu().detach().numpy()[:, :, j, 1])
+
+            row_labels = ["x", "y", "preds"]
+            for ax_, row in zip(ax[:, 0], row_labels):
+                ax_.set_ylabel(row)
+
+            col_labels = ["frame1", "frame2", "frame3", "frame4"]
+            for ax_, col in zip(ax[0, :], col_labels):
+                ax_.set_title(col)
+
+            save_path = os.path.join(path, f"pred_{epoch}.png")
+            plt.savefig(save_path)
+            plt.close()
+            model.train()
+            # term_display(y, preds)
+            return
     print("Raininess threshold too strict, hasn't found anything")
 
 
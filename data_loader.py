@@ -2,9 +2,13 @@ import os
 import torch as t
 import ipdb
 import matplotlib.pyplot as plt
+from sequence_data.loader import SequenceLoader
+from sequence_data.sources import PtSource
 
 
-class DataLoader:
+class DataLoader(SequenceLoader):
+    # windows of seq_len input and seq_len target frames of the `.pt`
+    # sequences in `folder`
     def __init__(
         self,
         folder: str,
@@ -16,70 +20,16 @@ class DataLoader:
         seq_len: int = 4
     ):
         self.seq_len = seq_len
-        self.crop = crop
-        self.data_folder = folder
-        self.device = device
-        self.batch_size = batch_size
-        self.file_index = 0
         self.folder = folder
-        self.files = tuple(
-            os.path.join(folder, fn) for fn in sorted(os.listdir(folder))
+        super().__init__(
+            PtSource(folder),
+            batch_size,
+            device,
+            in_len=seq_len,
+            out_len=seq_len,
+            crop=crop,
+            shuffle=shuffle,
         )
-        self.shuffle = shuffle
-        if self.shuffle:
-            rand_indices = t.randperm(len(self.files))
-            tmp = tuple(self.files[i] for i in rand_indices)
-            self.files = tmp
-        self.remainder = self.__read_next_file()
-        self.file_length = self.remainder.shape[0] * self.remainder.shape[1]
-
-    def __read_next_file(self) -> t.Tensor:
-        if self.file_index == len(self.files):
-            raise StopIteration
-        data = t.load(self.files[self.file_index])
-        self.file_index += 1
-        result = self.__segmentify(data)
-        return result
-
-    def __segmentify(self, data: t.Tensor) -> t.Tensor:
-        data = data[: (len(data) // 2 * self.seq_len) * 2 * self.seq_len]
-        if self.crop is not None:
-            data = data[:, :, : self.crop, : self.crop]
-
-        segments = t.stack(
-            tuple(
-                el
-                for el in tuple(
-                    data[i : i + 2 * self.seq_len] for i in range(len(data))
-                )
-                if len(el) == 2 * self.seq_len
-            )
-        )
-        return segments
-
-    def __next__(self) -> tuple[t.Tensor, t.Tensor]:
-        if self.remainder.shape[1] == 0:
-            data = self.__read_next_file()
-        else:
-            data = self.remainder
-        self.remainder = data[self.batch_size :]
-        result = data[: self.batch_size]
-        if len(result) == 0:
-            raise StopIteration
-        result = t.stack(
-            tuple(t.stack((s[: self.seq_len], s[self.seq_len :])) for s in result)
-        ).transpose(0, 1)
-        rand_indices = (
-            t.randperm(result.shape[1]) if self.shuffle else t.arange(result.shape[1])
-        )
-        results = (
-            result[0][rand_indices].float().to(self.device),
-            result[1][rand_indices].float().to(self.device),
-        )
-        return results
-
-    def __iter__(self):
-        return self
 
 
 def get_loaders(
@@ -3,10 +3,13 @@ import torch as t
 import ipdb
 import matplotlib.pyplot as plt
 from tqdm import tqdm
-import h5py
+from sequence_data.loader import SequenceLoader
+from sequence_data.datasets import DeviceLoader, WindowIterableDataset
+from sequence_data.sources import H5Source
 
 
-class DataLoader:
+class DataLoader(SequenceLoader):
+    # windows of the HDF5 sequences in `folder`, read by hyperslab
     def __init__(
         self,
         folder: str,
@@ -17,75 +20,37 @@ class DataLoader:
         shuffle: bool = True,
         in_seq_len: int = 4,
         out_seq_len: int = 4,
+        rank: int = 0,
+        world_size: int = 1,
+        drop_last: bool = False,
+        seed: int = 0,
+        epoch: int = 0,
+        chunk_cache_mb: int = 64,
+        read_ahead: int = 4,
     ):
         self.in_seq_len = in_seq_len
         self.out_seq_len = out_seq_len
         self.tot_seq_len = in_seq_len + out_seq_len
-        self.crop = crop
-        self.data_folder = folder
-        self.device = device
-        self.batch_size = batch_size
-        self.file_index = 0
         self.folder = folder
-        self.files = tuple(
-            os.path.join(folder, fn) for fn in sorted(os.listdir(folder))
-        )
-        self.shuffle = shuffle
-        if self.shuffle:
-            rand_indices = t.randperm(len(self.files))
-            tmp = tuple(self.files[i] for i in rand_indices)
-            self.files = tmp
-        self.remainder = self.__read_next_file()
-        self.file_length = self.remainder.shape[0] * self.remainder.shape[1]
-
-    def __read_next_file(self) -> t.Tensor:
-        if self.file_index == len(self.files):
-            raise StopIteration
-        # reads the next file in h5 format
-        with h5py.File(self.files[self.file_index], "r") as f:
-            data = t.from_numpy(f["default"][:])
-        # data = t.load(self.files[self.file_index])
-        self.file_index += 1
-        result = self.__segmentify(data)
-        return result
-
-    def __segmentify(self, data: t.Tensor) -> t.Tensor:
-        data = data[: (len(data) // self.tot_seq_len) * self.tot_seq_len]
-        if self.crop is not None:
-            data = data[:, :, : self.crop, : self.crop]
-        return data
-
-    def __next__(self) -> tuple[t.Tensor, t.Tensor]:
-        if self.remainder.shape[0] == 0:
-            data = self.__read_next_file()
-        else:
-            data = self.remainder
-        self.remainder = data[self.batch_size :]
-        segments = tuple(
-            data[i : i + self.tot_seq_len]
-            for i in range(self.batch_size)
-            if len(data[i : i + self.tot_seq_len]) == self.tot_seq_len
-        )
-        if len(segments) == 0:
-            raise StopIteration
-        result = t.stack(segments, dim=0)
-        if len(result) == 0:
-            raise StopIteration
-        xs = t.stack(tuple(s[: self.in_seq_len] for s in result))
-        ys = t.stack(tuple(s[self.in_seq_len :] for s in result))
-        rand_indices = (
-            t.randperm(result.shape[0])
-            if self.shuffle
-            else t.arange(result.shape[0])
-        )
-        results = (
-            xs[rand_indices].float().to(self.device),
-            ys[rand_indices].float().to(self.device),
+        super().__init__(
+            H5Source(folder, chunk_cache_mb=chunk_cache_mb),
+            batch_size,
+            device,
+            in_len=in_seq_len,
+            out_len=out_seq_len,
+            crop=crop,
+            shuffle=shuffle,
+            seed=seed,
+            rank=rank,
+            world_size=world_size,
+            drop_last=drop_last,
+            read_ahead=read_ahead,
         )
-        return results
+        self.epoch = epoch
 
-    def __iter__(self):
-        return self
+    def close(self):
+        self.reset()
+        self.source.close()
 
 
 def get_loaders(
@@ -97,9 +62,38 @@ def get_loaders(
     crop: int = 64,
     in_seq_len: int = 12,
     out_seq_len: int = 6,
+    rank: int = 0,
+    world_size: int = 1,
+    epoch: int = 0,
+    torch_workers: int = 0,
 ) -> tuple[DataLoader, DataLoader]:
     test_folder = os.path.join(data_location, "test")
     train_folder = os.path.join(data_location, "train")
+    if torch_workers > 0:
+        # the same windows, read by torch.utils.data worker processes
+        loaders = tuple(
+            DeviceLoader(
+                WindowIterableDataset(
+                    H5Source(folder),
+                    in_seq_len + out_seq_len,
+                    crop=crop,
+                    dtype=t.float32,
+                    rank=rank if folder == train_folder else 0,
+                    world_size=world_size if folder == train_folder else 1,
+                ),
+                batch_size,
+                device,
+                in_len=in_seq_len,
+                num_workers=torch_workers,
+            )
+            for folder, batch_size in (
+                (train_folder, train_batch_size),
+                (test_folder, test_batch_size),
+            )
+        )
+        for loader in loaders:
+            loader.set_epoch(epoch)
+        return loaders
     return (
         DataLoader(
             train_folder,
@@ -108,6 +102,9 @@ def get_loaders(
             in_seq_len=in_seq_len,
             out_seq_len=out_seq_len,
             crop=crop,
+            rank=rank,
+            world_size=world_size,
+            epoch=epoch,
         ),
         DataLoader(
             test_folder,
@@ -195,6 +195,11 @@ def train():
         "lr": 0.0002,  # Learning rate for optimizers
         "beta1": 0.5,  # Beta1 hyperparam for Adam optimizer
         "save_epoch": 2,
+        # share of the training files read by this process, as set by torchrun
+        "rank": int(os.environ.get("RANK", 0)),
+        "world_size": int(os.environ.get("WORLD_SIZE", 1)),
+        # processes of the torch input pipeline, 0 reads in this process
+        "workers": 0,
     }
 
     # Use GPU is available else use CPU.
@@ -236,16 +241,21 @@ def train():
     )
     history = TrainingHistory()
 
+    # built once, every epoch only reshuffles them
+    train_data_loader, test_data_loader = get_loaders(
+        "/mnt/tmp/multi_channel_train_test",
+        32,
+        64,
+        device,
+        in_seq_len=params["nc"],
+        out_seq_len=params["nc"],
+        rank=params["rank"],
+        world_size=params["world_size"],
+        torch_workers=params["workers"],
+    )
     for epoch in range(1, params["nepochs"] + 1):
-
-        train_data_loader, test_data_loader = get_loaders(
-            "/mnt/tmp/multi_channel_train_test",
-            32,
-            64,
-            device,
-            in_seq_len=params["nc"],
-            out_seq_len=params["nc"],
-        )
+        train_data_loader.set_epoch(epoch)
+        test_data_loader.set_epoch(epoch)
         train_result = train_single_epoch(
             dataloader=train_data_loader,
             netG=netG,
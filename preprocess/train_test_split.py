@@ -2,11 +2,51 @@ import torch as t
 import os
 import h5py
 import ipdb
+from tqdm import tqdm
+
+
+def copy_frames(
+    source: h5py.Dataset,
+    out_file_name: str,
+    start: int,
+    stop: int,
+    *,
+    chunk_frames: int = 16,
+    chunk_size: int = 64,
+    compression: str = None,
+    block: int = 256,
+):
+    # copies source[start:stop] in blocks of frames, so memory stays bounded
+    # whatever the size of the archive. Chunks span a few frames and a crop
+    # sized tile, like the windows the loaders read.
+    frame_shape = source.shape[1:]
+    chunks = (
+        min(chunk_frames, max(stop - start, 1)),
+        *frame_shape[:-2],
+        *(min(chunk_size, size) for size in frame_shape[-2:]),
+    )
+    with h5py.File(out_file_name, "w") as f:
+        out = f.create_dataset(
+            "default",
+            shape=(stop - start, *frame_shape),
+            dtype=source.dtype,
+            chunks=chunks,
+            compression=compression,
+        )
+        # frames [start, stop) of the source archive
+        out.attrs["source"] = source.file.filename
+        out.attrs["start"] = start
+        out.attrs["stop"] = stop
+        desc = os.path.basename(out_file_name)
+        for i in tqdm(range(start, stop, block), desc=desc):
+            end = min(i + block, stop)
+            out[i - start : end - start] = source[i:end]
 
 
 def main(
     in_file_name="/mnt/tmp/data.hdf5",
     out_dir: str = "/mnt/tmp/multi_channel_train_test",
+    compression: str = "lzf",
 ):
     if not os.path.exists(out_dir):
         os.mkdir(out_dir)
@@ -19,22 +59,20 @@ def main(
     with h5py.File(
         in_file_name, "r"
     ) as f:  # "r" means that hdf5 file is open in read-only mode
-        data = t.from_numpy(f["default"][:])
-    test_size = int(0.2 * len(data))
-    to_cut = (test_size + 16) // 2
-    test_1 = data[:to_cut]
-    test_2 = data[-to_cut:]
-
-    train = data[to_cut:-to_cut]
-
-    assert len(train) + len(test_1) + len(test_2) == len(data), "whoops"
-    # saves the data in h5 format
-    with h5py.File(os.path.join(out_dir, "test", "test_1.h5"), "w") as f:
-        f["default"] = test_1.numpy()
-    with h5py.File(os.path.join(out_dir, "test", "test_2.h5"), "w") as f:
-        f["default"] = test_2.numpy()
-    with h5py.File(os.path.join(out_dir, "train", "train.h5"), "w") as f:
-        f["default"] = train.numpy()
+        data = f["default"]
+        test_size = int(0.2 * len(data))
+        to_cut = (test_size + 16) // 2
+        # the first and last `to_cut` frames are the test set
+        n = len(data)
+        splits = {
+            os.path.join(out_dir, "test", "test_1.h5"): (0, to_cut),
+            os.path.join(out_dir, "test", "test_2.h5"): (n - to_cut, n),
+            os.path.join(out_dir, "train", "train.h5"): (to_cut, n - to_cut),
+        }
+        assert sum(stop - start for start, stop in splits.values()) == n, "whoops"
+        # saves the data in h5 format
+        for out_file_name, (start, stop) in splits.items():
+            copy_frames(data, out_file_name, start, stop, compression=compression)
     """
     t.save(test_1, os.path.join(out_dir, "test", "1.pt"))
     t.save(test_2, os.path.join(out_dir, "test", "2.pt"))
@@ -0,0 +1,268 @@
+import multiprocessing
+import numpy as np
+import torch as t
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+from torch.utils.data import DataLoader as TorchDataLoader
+from torch.utils.data._utils.collate import default_collate
+from typing import Callable
+from .sharding import shard_indices
+from .window_index import build_window_index, count_windows
+from .windows import sliding_windows, split_windows
+
+# Adapters from sources (see sources.py) to `torch.utils.data`, for training
+# with the standard multi-process input pipeline (worker processes, pinned
+# memory, persistent workers, prefetch_factor) instead of the threaded loaders.
+# Items are single windows of `window_size` frames; WindowCollate stacks them
+# and splits the batch into input and target frames:
+#   WindowDataset          -> map-style, item k is row k of the window index,
+#                             or directly a (sequence, offset) row, so a
+#                             WindowSampler can be used as the batch sampler
+#   WindowIterableDataset  -> reads sequences in blocks of consecutive windows,
+#                             blocks are split between ranks, then between the
+#                             worker processes of each rank, one by one or with
+#                             `whole_sequences` all those of a sequence at once
+#   SampledBatches         -> the batches of a WindowSampler over a
+#                             WindowDataset, each worker process reading whole
+#                             file groups of the sampler
+# DeviceLoader wraps the torch DataLoader with the interface of the project
+# loaders (set_epoch, queue_stats, batches on the device).
+
+
+class WindowDataset(Dataset):
+    def __init__(
+        self,
+        source,
+        window_size: int,
+        *,
+        crop=None,
+        dtype: t.dtype = None,
+        truncate: bool = True,
+    ):
+        self.source = source
+        self.window_size = window_size
+        self.crop = crop
+        self.dtype = dtype
+        lengths = [source.length(i) for i in range(len(source))]
+        self.index = build_window_index(lengths, window_size, truncate)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, item) -> t.Tensor:
+        i, offset = self.index[item] if np.ndim(item) == 0 else item
+        window = self.source.read(
+            int(i), int(offset), int(offset) + self.window_size, self.crop, self.dtype
+        )
+        # a copy, or the whole decoded sequence would be sent to the main process
+        return window.clone()
+
+
+class WindowIterableDataset(IterableDataset):
+    def __init__(
+        self,
+        source,
+        window_size: int,
+        *,
+        crop=None,
+        dtype: t.dtype = None,
+        truncate: bool = True,
+        block: int = 256,
+        shuffle: bool = True,
+        seed: int = 0,
+        rank: int = 0,
+        world_size: int = 1,
+        drop_last: bool = False,
+        whole_sequences: bool = False,
+    ):
+        self.source = source
+        self.window_size = window_size
+        self.crop = crop
+        self.dtype = dtype
+        self.truncate = truncate
+        self.block = block
+        self.whole_sequences = whole_sequences
+        self.shuffle = shuffle
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.drop_last = drop_last
+        # shared with the worker processes, so that persistent workers see
+        # the epoch set after they were started
+        self.epoch = multiprocessing.RawValue("q", 0)
+
+    def set_epoch(self, epoch: int):
+        self.epoch.value = epoch
+
+    def blocks(self) -> list[tuple[int, int, int]]:
+        # (sequence, first window, last window + 1) of every block
+        blocks = []
+        for i in range(len(self.source)):
+            n_windows = count_windows(
+                self.source.length(i), self.window_size, self.truncate
+            )
+            for start in range(0, n_windows, self.block):
+                blocks.append((i, start, min(start + self.block, n_windows)))
+        return blocks
+
+    def worker_blocks(self, worker: int = 0, num_workers: int = 1) -> list:
+        blocks = self.blocks()
+        order = shard_indices(
+            len(blocks),
+            self.rank,
+            self.world_size,
+            shuffle=self.shuffle,
+            seed=self.seed,
+            epoch=self.epoch.value,
+            drop_last=self.drop_last,
+        ).tolist()
+        if not self.whole_sequences:
+            # the rank's blocks are dealt to its workers, none is read twice
+            return [blocks[b] for b in order[worker::num_workers]]
+        # sources that decode a sequence whole (PtSource) give every block of
+        # a sequence to the same worker, the one with the fewest windows so
+        # far, so that each sequence is decoded by a single worker
+        sequences = {}
+        for b in order:
+            sequences.setdefault(blocks[b][0], []).append(blocks[b])
+        n_windows = [0] * num_workers
+        worker_blocks = []
+        for sequence_blocks in sequences.values():
+            w = n_windows.index(min(n_windows))
+            n_windows[w] += sum(stop - start for _, start, stop in sequence_blocks)
+            if w == worker:
+                worker_blocks.extend(sequence_blocks)
+        return worker_blocks
+
+    def __iter__(self):
+        worker = get_worker_info()
+        if worker is not None:
+            blocks = self.worker_blocks(worker.id, worker.num_workers)
+        else:
+            blocks = self.worker_blocks()
+        for i, start, stop in blocks:
+            frames = self.source.read(
+                i, start, stop + self.window_size - 1, self.crop, self.dtype
+            )
+            windows = sliding_windows(frames, self.window_size)
+            rand_indices = (
+                t.randperm(len(windows)) if self.shuffle else t.arange(len(windows))
+            )
+            for k in rand_indices.tolist():
+                yield windows[k].clone()
+
+
+class SampledBatches(IterableDataset):
+    # a batch sampler would deal consecutive batches, and so the files of a
+    # group, to all workers; sources that decode a sequence whole (PtSource)
+    # would then decode every file once per worker. Items are lists of windows.
+    def __init__(self, dataset: WindowDataset, sampler):
+        self.dataset = dataset
+        self.sampler = sampler
+        self.epoch = multiprocessing.RawValue("q", 0)
+
+    def set_epoch(self, epoch: int):
+        self.epoch.value = epoch
+
+    def worker_batches(self, worker: int = 0, num_workers: int = 1) -> list:
+        self.sampler.set_epoch(self.epoch.value)
+        return self.sampler.worker_batches(worker, num_workers)
+
+    def __iter__(self):
+        worker = get_worker_info()
+        if worker is not None:
+            batches = self.worker_batches(worker.id, worker.num_workers)
+        else:
+            batches = self.worker_batches()
+        for rows in batches:
+            yield [self.dataset[row] for row in rows]
+
+
+class WindowCollate:
+    # a class rather than a closure, so it can be sent to worker processes
+    def __init__(self, in_len: int):
+        self.in_len = in_len
+
+    def __call__(self, windows: list[t.Tensor]) -> tuple[t.Tensor, t.Tensor]:
+        # in a worker, the batch is stacked straight into shared memory
+        return split_windows(default_collate(windows), self.in_len)
+
+
+class DeviceLoader:
+    def __init__(
+        self,
+        dataset,
+        batch_size: int,
+        device,
+        *,
+        in_len: int = 4,
+        transform: Callable[[t.Tensor], t.Tensor] = None,
+        batch_sampler=None,
+        num_workers: int = 4,
+        prefetch_factor: int = 2,
+        persistent_workers: bool = True,
+    ):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.device = device
+        self.transform = transform
+        self.batch_sampler = batch_sampler
+        self.epoch = 0
+        # torch only accepts these options with worker processes
+        options = (
+            {
+                "prefetch_factor": prefetch_factor,
+                "persistent_workers": persistent_workers,
+            }
+            if num_workers > 0
+            else {}
+        )
+        if batch_sampler is not None:
+            options["batch_sampler"] = batch_sampler
+        elif isinstance(dataset, SampledBatches):
+            # items are already batches, collated one by one
+            options["batch_size"] = None
+        else:
+            options["batch_size"] = batch_size
+        self.loader = TorchDataLoader(
+            dataset,
+            num_workers=num_workers,
+            collate_fn=WindowCollate(in_len),
+            pin_memory=t.device(device).type == "cuda",
+            **options,
+        )
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+        if self.batch_sampler is not None:
+            self.batch_sampler.set_epoch(epoch)
+        if hasattr(self.dataset, "set_epoch"):
+            self.dataset.set_epoch(epoch)
+
+    def queue_stats(self) -> dict:
+        return {}
+
+    def __len__(self):
+        if isinstance(self.dataset, SampledBatches):
+            num_workers = max(self.loader.num_workers, 1)
+            return sum(
+                len(self.dataset.worker_batches(w, num_workers))
+                for w in range(num_workers)
+            )
+        if isinstance(self.dataset, IterableDataset):
+            # every worker batches its own blocks, ending on a partial batch
+            num_workers = max(self.loader.num_workers, 1)
+            n_batches = 0
+            for w in range(num_workers):
+                blocks = self.dataset.worker_blocks(w, num_workers)
+                n_windows = sum(stop - start for _, start, stop in blocks)
+                n_batches += -(-n_windows // self.batch_size)
+            return n_batches
+        return len(self.loader)
+
+    def __iter__(self):
+        for xs, ys in self.loader:
+            xs = xs.to(self.device, non_blocking=True)
+            ys = ys.to(self.device, non_blocking=True)
+            if self.transform is not None:
+                xs, ys = self.transform(xs), self.transform(ys)
+            yield xs, ys
@@ -0,0 +1,56 @@
+import fcntl
+import os
+from contextlib import contextmanager
+
+# Derived files (lengths, window indexes, stores, layouts, statistics) are
+# built by the first process that needs them, and with sharded loaders every
+# rank of a run needs them at the same time. They are written under a
+# temporary name and renamed into place, so a reader never sees a partial file
+# and a file mapped by a reader is never truncated, and built while holding a
+# lock next to them, so the other ranks wait and then use the result instead
+# of writing the same files again. A builder checks again once it holds the
+# lock. Caches next to a dataset that cannot be written (a read-only mount)
+# are computed without being kept.
+
+
+def temp_path(path: str) -> str:
+    return f"{path}.{os.getpid()}.tmp"
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = "w"):
+    tmp = temp_path(path)
+    try:
+        with open(tmp, mode) as f:
+            yield f
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def can_write(path: str) -> bool:
+    # whether `path` can be written, creating its missing folders
+    folder = os.path.dirname(os.path.abspath(path))
+    while not os.path.exists(folder):
+        folder = os.path.dirname(folder)
+    return os.access(folder, os.W_OK)
+
+
+@contextmanager
+def file_lock(path: str):
+    # exclusive between processes and between threads, for as long as the
+    # block runs; the lock file, hidden next to `path`, is never removed.
+    # Yields whether `path` can be written: when it cannot, there is no lock
+    # and nothing should be written
+    if not can_write(path):
+        yield False
+        return
+    folder, name = os.path.split(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, f".{name}.lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
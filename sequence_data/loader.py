@@ -0,0 +1,164 @@
+import torch as t
+from .prefetch import PinnedBufferPool, Prefetcher
+from .sharding import default_seed, shard_indices, shard_order
+from .window_index import count_windows
+from .windows import sliding_windows, split_windows
+
+# The batching core shared by the sequence loaders. Every sequence of a
+# source is truncated to a multiple of the window length (in_len + out_len),
+# unless `truncate` is off, and windowed with a step of one frame; a batch is
+# `batch_size` windows with consecutive first frames, read as one block of
+# frames and gathered from its strided window views into a single (pinned, on
+# CUDA) buffer, shuffled within the batch. Sequences are visited in an order
+# derived from seed + epoch, and the batches of that order are split between
+# ranks, so every rank gets the same number of batches however few sequences
+# there are; reading and gathering run on background workers.
+#
+# Loaders with other batches override the hooks:
+#   tasks()          -> the tasks of an epoch for this rank
+#   read_batch(task) -> yields (buffer slot, batch) for the batches of a task,
+#                       on a worker; buffer() gives the memory to gather into
+#   output(batch)    -> the batch once on the device, as the model takes it
+
+
+class SequenceLoader:
+    def __init__(
+        self,
+        source,
+        batch_size: int,
+        device,
+        *,
+        in_len: int = 4,
+        out_len: int = 4,
+        crop=None,
+        truncate: bool = True,
+        shuffle: bool = True,
+        dtype: t.dtype = t.float32,
+        seed: int = None,
+        rank: int = 0,
+        world_size: int = 1,
+        drop_last: bool = False,
+        num_workers: int = 1,
+        queue_size: int = None,
+        read_ahead: int = 4,
+    ):
+        self.source = source
+        self.batch_size = batch_size
+        self.device = device
+        self.in_len = in_len
+        self.window_size = in_len + out_len
+        self.crop = crop
+        self.truncate = truncate
+        self.shuffle = shuffle
+        self.dtype = dtype
+        self.seed = default_seed(world_size) if seed is None else seed
+        self.rank = rank
+        self.world_size = world_size
+        self.drop_last = drop_last
+        self.num_workers = num_workers
+        # batches waiting to be consumed, and tasks read ahead of the one being
+        # consumed when batches are ordered
+        self.queue_size = read_ahead if queue_size is None else queue_size
+        self.read_ahead = read_ahead
+        self.epoch = 0
+        self.buffers = (
+            PinnedBufferPool(self.queue_size + num_workers + 1)
+            if t.device(device).type == "cuda"
+            else None
+        )
+        # nothing is read until the first batch is requested
+        self.prefetcher = None
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+        self.reset()
+
+    def reset(self):
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+        self.prefetcher = None
+
+    def n_windows(self, i: int) -> int:
+        return count_windows(self.source.length(i), self.window_size, self.truncate)
+
+    def tasks(self) -> list:
+        # (sequence, first window, last window + 1) of the batches of this rank
+        sequences = shard_indices(
+            len(self.source),
+            0,
+            1,
+            shuffle=self.shuffle,
+            seed=self.seed,
+            epoch=self.epoch,
+        ).tolist()
+        tasks = [
+            (i, start, min(start + self.batch_size, n_windows))
+            for i, n_windows in ((i, self.n_windows(i)) for i in sequences)
+            for start in range(0, n_windows, self.batch_size)
+        ]
+        # contiguous runs of batches, which keeps ranks on separate sequences
+        # as far as possible
+        batches = shard_order(
+            t.arange(len(tasks)), self.rank, self.world_size, self.drop_last
+        )
+        return [tasks[b] for b in batches.tolist()]
+
+    def __len__(self):
+        return len(self.tasks())
+
+    def buffer(self, shape: tuple[int, ...], dtype: t.dtype):
+        # batches are written straight into pinned memory when they go to a GPU
+        if self.buffers is not None:
+            return self.buffers.acquire(shape, dtype)
+        return None, t.empty(shape, dtype=dtype)
+
+    def read_batch(self, task):
+        i, start, stop = task
+        # one block of frames covers every window of the batch
+        frames = self.source.read(
+            i, start, stop + self.window_size - 1, crop=self.crop, dtype=self.dtype
+        )
+        windows = sliding_windows(frames, self.window_size)
+        rand_indices = (
+            t.randperm(len(windows)) if self.shuffle else t.arange(len(windows))
+        )
+        # the only copy of the windows, a single gather from the strided views
+        slot, out = self.buffer(tuple(windows.shape), windows.dtype)
+        yield slot, t.index_select(windows, 0, rand_indices, out=out)
+
+    def discard(self, item):
+        # a batch read but never consumed gives its pinned buffer back
+        slot, _ = item
+        if slot is not None:
+            self.buffers.release(slot)
+
+    def to_device(self, slot, batch: t.Tensor) -> t.Tensor:
+        if self.buffers is not None:
+            return self.buffers.to_device(slot, batch, self.device)
+        return batch.to(self.device)
+
+    def output(self, batch: t.Tensor):
+        return split_windows(batch, self.in_len)
+
+    def __next__(self):
+        if self.prefetcher is None:
+            self.prefetcher = Prefetcher(
+                self.tasks(),
+                self.read_batch,
+                num_workers=self.num_workers,
+                queue_size=self.queue_size,
+                ordered=not self.shuffle,
+                read_ahead=self.read_ahead,
+                discard=self.discard,
+            )
+        slot, batch = next(self.prefetcher)
+        return self.output(self.to_device(slot, batch))
+
+    def __iter__(self):
+        # every loop over the loader is a new pass over the sequences
+        self.reset()
+        return self
+
+    def queue_stats(self) -> dict:
+        return self.prefetcher.stats() if self.prefetcher is not None else {}
+
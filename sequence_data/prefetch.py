@@ -0,0 +1,253 @@
+import queue
+import time
+from threading import Condition, Event, Thread, current_thread
+from typing import Callable, Iterable
+import torch as t
+
+# Background input pipeline shared by the loaders: a pool of worker threads
+# takes tasks (files, or batches of window index rows), turns each of them into
+# one or more CPU batches and puts those in a bounded queue. Decoding, gathering
+# and normalization run on the workers (torch and h5py release the GIL for the
+# heavy parts), the training thread only pops finished batches.
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class PinnedBufferPool:
+    # Reusable page-locked host buffers, so host to device copies can be
+    # asynchronous. A buffer goes back to the pool with the CUDA event of the
+    # copy reading it, and is only handed out again once that copy is done.
+    # When every buffer is in use a plain tensor is returned instead of
+    # blocking, so workers can never wait on batches held by the consumer.
+    def __init__(self, size: int):
+        self.slots = queue.Queue()
+        for _ in range(size):
+            self.slots.put({"buffer": None, "event": None})
+
+    def acquire(self, shape: tuple[int, ...], dtype: t.dtype):
+        try:
+            slot = self.slots.get_nowait()
+        except queue.Empty:
+            return None, t.empty(shape, dtype=dtype)
+        if slot["event"] is not None:
+            slot["event"].synchronize()
+            slot["event"] = None
+        numel = 1
+        for s in shape:
+            numel *= s
+        buffer = slot["buffer"]
+        if buffer is None or buffer.dtype != dtype or buffer.numel() < numel:
+            buffer = t.empty(numel, dtype=dtype).pin_memory()
+            slot["buffer"] = buffer
+        return slot, buffer[:numel].view(shape)
+
+    def release(self, slot, event=None):
+        slot["event"] = event
+        self.slots.put(slot)
+
+    def pin(self, tensor: t.Tensor):
+        slot, out = self.acquire(tuple(tensor.shape), tensor.dtype)
+        out.copy_(tensor)
+        return slot, out
+
+    def to_device(self, slot, tensor: t.Tensor, device) -> t.Tensor:
+        if slot is None:
+            return tensor.to(device)
+        result = tensor.to(device, non_blocking=True)
+        event = t.cuda.Event()
+        event.record()
+        self.release(slot, event)
+        return result
+
+
+class Prefetcher:
+    # With `ordered`, batches come out in task order whatever worker finishes
+    # first; batches of tasks that are ahead wait in a small reorder buffer.
+    # `read_ahead` bounds how many tasks past the one being consumed can be
+    # started, and so the size of that buffer. Batches that are never consumed,
+    # because the pass is closed early, are handed to `discard` (to give their
+    # buffers back).
+    def __init__(
+        self,
+        tasks: Iterable,
+        fn: Callable[..., Iterable],
+        *,
+        num_workers: int = 2,
+        queue_size: int = 4,
+        ordered: bool = False,
+        read_ahead: int = None,
+        discard: Callable = None,
+    ):
+        self.tasks = enumerate(tasks)
+        self.fn = fn
+        self.discard = discard
+        self.num_workers = num_workers
+        self.ordered = ordered
+        self.read_ahead = read_ahead if ordered else None
+        self.task_lock = Condition()
+        self.issued_tasks = 0
+        self.exhausted = False
+        self.stop_event = Event()
+        self.queue = queue.Queue(maxsize=max(queue_size, 1))
+        self.pending = {}
+        self.done_tasks = set()
+        self.current_task = 0
+        self.finished_workers = 0
+        self.n_batches = 0
+        self.n_starved = 0
+        self.n_full = 0
+        self.wait_time = 0.0
+        if num_workers == 0:
+            self.inline = (batch for _, task in self.tasks for batch in fn(task))
+        else:
+            self.workers = [
+                Thread(target=self.__work, daemon=True) for _ in range(num_workers)
+            ]
+            for worker in self.workers:
+                worker.start()
+
+    def __next_task(self):
+        with self.task_lock:
+            while (
+                self.read_ahead is not None
+                and not self.exhausted
+                and self.issued_tasks - self.current_task > self.read_ahead
+                and not self.stop_event.is_set()
+            ):
+                self.task_lock.wait(0.1)
+            task_no, task = next(self.tasks, (None, _END))
+            if task is _END:
+                self.exhausted = True
+            else:
+                self.issued_tasks += 1
+            return task_no, task
+
+    def __put(self, item) -> bool:
+        if self.queue.full():
+            self.n_full += 1
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __work(self):
+        try:
+            task_no, task = self.__next_task()
+            while task is not _END and not self.stop_event.is_set():
+                for batch in self.fn(task):
+                    if not self.__put((task_no, batch)):
+                        self.__discard(batch)
+                        return
+                self.__put((task_no, _END))
+                task_no, task = self.__next_task()
+        except BaseException as e:
+            self.__put((None, _Failure(e)))
+        self.__put((None, _END))
+
+    def __get(self):
+        try:
+            return self.queue.get_nowait(), False
+        except queue.Empty:
+            # the training loop is waiting for input
+            start = time.perf_counter()
+            item = self.queue.get()
+            self.wait_time += time.perf_counter() - start
+            return item, True
+
+    def __batch(self, batch, starved: bool):
+        self.n_batches += 1
+        self.n_starved += int(starved)
+        return batch
+
+    def __pop_ready(self):
+        if not self.ordered:
+            return _END
+        while True:
+            batches = self.pending.get(self.current_task, [])
+            if len(batches) > 0:
+                return batches.pop(0)
+            if self.current_task not in self.done_tasks:
+                return _END
+            self.pending.pop(self.current_task, None)
+            with self.task_lock:
+                self.current_task += 1
+                self.task_lock.notify_all()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.num_workers == 0:
+            start = time.perf_counter()
+            batch = next(self.inline)
+            self.wait_time += time.perf_counter() - start
+            self.n_batches += 1
+            return batch
+        starved = False
+        while True:
+            batch = self.__pop_ready()
+            if batch is not _END:
+                return self.__batch(batch, starved)
+            if self.finished_workers == self.num_workers:
+                for worker in self.workers:
+                    worker.join()
+                raise StopIteration
+            (task_no, item), waited = self.__get()
+            starved = starved or waited
+            if isinstance(item, _Failure):
+                self.close()
+                raise item.error
+            if task_no is None:
+                self.finished_workers += 1
+            elif not self.ordered:
+                if item is not _END:
+                    return self.__batch(item, starved)
+            elif item is _END:
+                self.done_tasks.add(task_no)
+            else:
+                self.pending.setdefault(task_no, []).append(item)
+
+    def __discard(self, batch):
+        if self.discard is not None:
+            self.discard(batch)
+
+    def close(self):
+        self.stop_event.set()
+        if self.num_workers == 0:
+            return
+        # workers give up within a batch once stopped; then nothing can be
+        # added to what they left in the queue and the reorder buffer
+        for worker in self.workers:
+            if worker is not current_thread():
+                worker.join()
+        while True:
+            try:
+                task_no, item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if task_no is not None and item is not _END:
+                self.__discard(item)
+        for batches in self.pending.values():
+            for batch in batches:
+                self.__discard(batch)
+        self.pending.clear()
+
+    def __del__(self):
+        self.close()
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.n_batches,
+            "starved": self.n_starved,
+            "starved_fraction": self.n_starved / max(self.n_batches, 1),
+            "wait_s": self.wait_time,
+            "queue_full": self.n_full,
+        }
@@ -0,0 +1,50 @@
+import torch as t
+
+# Splits the items of an epoch (windows or files) between `world_size`
+# processes. Every process derives the same order from seed + epoch and keeps
+# its own contiguous block of it, so the shards are disjoint, cover the epoch
+# and all have the same size: with `drop_last` the items that do not divide
+# evenly are dropped, otherwise the order is padded by repeating its start.
+# Contiguous blocks keep each process on its own files when the order is
+# grouped by file.
+
+
+def default_seed(world_size: int = 1) -> int:
+    # a random seed, unless the order has to be the same on every rank
+    return 0 if world_size > 1 else int(t.randint(2 ** 31, (1,)))
+
+
+def shard_size(n: int, world_size: int, drop_last: bool = False) -> int:
+    return n // world_size if drop_last else -(-n // world_size)
+
+
+def shard_order(
+    order: t.Tensor, rank: int, world_size: int, drop_last: bool = False
+) -> t.Tensor:
+    assert 0 <= rank < world_size, f"rank {rank} not in [0, {world_size})"
+    if world_size == 1:
+        return order
+    size = shard_size(len(order), world_size, drop_last)
+    total = size * world_size
+    if total > len(order) and len(order) > 0:
+        order = order.repeat(-(-total // len(order)))
+    return order[rank * size : (rank + 1) * size]
+
+
+def shard_indices(
+    n: int,
+    rank: int,
+    world_size: int,
+    *,
+    shuffle: bool = True,
+    seed: int = 0,
+    epoch: int = 0,
+    drop_last: bool = False,
+) -> t.Tensor:
+    if shuffle:
+        generator = t.Generator()
+        generator.manual_seed(seed + epoch)
+        order = t.randperm(n, generator=generator)
+    else:
+        order = t.arange(n)
+    return shard_order(order, rank, world_size, drop_last)
@@ -0,0 +1,202 @@
+import os
+import numpy as np
+import torch as t
+import h5py
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable
+from .splits import file_ids
+from .window_index import sequence_lengths
+from .window_store import WindowStore, list_sequence_files
+
+# Storage backends of the sequence loader. A source is a list of sequences of
+# frames (time first, then any frame shape ending in height x width) with
+#   len(source)                          -> number of sequences
+#   source.length(i)                     -> number of frames of sequence i
+#   source.read(i, start, stop, crop, dtype)
+#       -> frames start:stop of sequence i, cropped to their top-left
+#          crop x crop (or height x width, for a pair) pixels and converted
+#          to dtype
+# Each backend reads as little as its format allows. Sources can be handed to
+# worker processes: open files and caches are not pickled, and are reopened by
+# the process that uses them.
+
+
+def _crop_size(crop) -> tuple[int, int]:
+    if crop is None:
+        return None, None
+    return (crop, crop) if isinstance(crop, int) else tuple(crop)
+
+
+def _crop(frames: t.Tensor, crop=None) -> t.Tensor:
+    height, width = _crop_size(crop)
+    return frames[..., :height, :width]
+
+
+class PtSource:
+    # `.pt` files are decoded whole, with `load`; the last `cache_size` decoded
+    # files are kept, since a loader reads consecutive batches from the same
+    # sequences, and workers reading a file being decoded wait for it instead
+    # of decoding it again
+    def __init__(
+        self,
+        folder: str,
+        files: tuple[str, ...] = None,
+        cache_size: int = 1,
+        load: Callable[[str], t.Tensor] = t.load,
+    ):
+        self.folder = folder
+        self.files = list_sequence_files(folder) if files is None else files
+        self.lengths = sequence_lengths(folder, self.files)
+        self.cache_size = cache_size
+        self.load = load
+        self.lock = Lock()
+        self.cache = OrderedDict()
+        self.loading = {}
+
+    def __getstate__(self):
+        return {
+            k: v
+            for k, v in self.__dict__.items()
+            if k not in ("lock", "cache", "loading")
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
+        self.cache = OrderedDict()
+        self.loading = {}
+
+    def __len__(self):
+        return len(self.files)
+
+    def length(self, i: int) -> int:
+        return self.lengths[i]
+
+    def read(
+        self, i: int, start: int, stop: int, crop: int = None, dtype: t.dtype = None
+    ) -> t.Tensor:
+        frames = _crop(self.__decoded(i)[start:stop], crop)
+        return frames if dtype is None else frames.to(dtype)
+
+    def __decoded(self, i: int) -> t.Tensor:
+        with self.lock:
+            data = self.cache.get(i)
+            if data is not None:
+                self.cache.move_to_end(i)
+                return data
+            loading = self.loading.setdefault(i, Lock())
+        with loading:
+            with self.lock:
+                data = self.cache.get(i)
+            if data is None:
+                data = self.load(os.path.join(self.folder, self.files[i]))
+                with self.lock:
+                    self.cache[i] = data
+                    if len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+                    self.loading.pop(i, None)
+        return data
+
+
+class H5Source:
+    # one dataset per HDF5 file, read by hyperslab: only the frames and the
+    # pixels of the crop are read, converted to dtype by HDF5 while reading.
+    # Files stay open with a chunk cache sized for a few batches, where
+    # chunks that were read completely are evicted first (w0=1).
+    def __init__(self, folder: str, key: str = "default", chunk_cache_mb: int = 64):
+        self.folder = folder
+        self.key = key
+        self.chunk_cache_mb = chunk_cache_mb
+        self.files = tuple(
+            sorted(fn for fn in os.listdir(folder) if fn.endswith((".h5", ".hdf5")))
+        )
+        self.handles = {}
+        self.pid = os.getpid()
+        self.lengths = [len(self.dataset(i)) for i in range(len(self.files))]
+
+    def __getstate__(self):
+        return {k: v for k, v in self.__dict__.items() if k != "handles"}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.handles = {}
+
+    def dataset(self, i: int) -> h5py.Dataset:
+        if self.pid != os.getpid():
+            # HDF5 handles must not be shared with forked workers, which open
+            # their own
+            self.handles = {}
+            self.pid = os.getpid()
+        if i not in self.handles:
+            self.handles[i] = h5py.File(
+                os.path.join(self.folder, self.files[i]),
+                "r",
+                rdcc_nbytes=self.chunk_cache_mb * 2 ** 20,
+                rdcc_nslots=100_003,
+                rdcc_w0=1.0,
+            )
+        return self.handles[i][self.key]
+
+    def __len__(self):
+        return len(self.files)
+
+    def length(self, i: int) -> int:
+        return self.lengths[i]
+
+    def read(
+        self, i: int, start: int, stop: int, crop: int = None, dtype: t.dtype = None
+    ) -> t.Tensor:
+        dataset = self.dataset(i)
+        height, width = _crop_size(crop)
+        selection = (
+            slice(start, stop),
+            *(slice(None) for _ in range(dataset.ndim - 3)),
+            slice(None, height),
+            slice(None, width),
+        )
+        shape = tuple(
+            len(range(*sl.indices(size))) for sl, size in zip(selection, dataset.shape)
+        )
+        if dtype is not None:
+            np_dtype = t.empty(0, dtype=dtype).numpy().dtype
+        else:
+            np_dtype = dataset.dtype
+        frames = np.empty(shape, dtype=np_dtype)
+        dataset.read_direct(frames, selection)
+        return t.from_numpy(frames)
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+        self.handles = {}
+
+
+class StoreSource:
+    # sequences of a memory-mapped window store, or only `files` of them;
+    # crops are served from its spatial tiles when it has them
+    def __init__(self, store: WindowStore, files: list[str] = None):
+        self.store = store
+        self.ids = file_ids(store.files, files).tolist()
+        self.files = tuple(store.files[i] for i in self.ids)
+        self.lengths = np.diff(store.offsets)[self.ids].tolist()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def length(self, i: int) -> int:
+        return self.lengths[i]
+
+    def read(
+        self, i: int, start: int, stop: int, crop: int = None, dtype: t.dtype = None
+    ) -> t.Tensor:
+        height, width = _crop_size(crop)
+        # the store crops squares, the tiles covering the larger side are read
+        frames = self.store.sequence(
+            self.ids[i],
+            crop=max(height, width) if crop else None,
+            start=start,
+            stop=stop,
+        )
+        frames = _crop(frames, crop)
+        return frames if dtype is None else frames.to(dtype)
@@ -0,0 +1,112 @@
+import os
+import json
+import math
+import numpy as np
+
+# Splits as manifest files instead of folders: sequences stay where they were
+# written, in one folder of the dataset, and <data>/splits/<name>.json lists
+# the sequences of every split of the scheme `name`:
+#   {"folder": <folder of the sequences, relative to <data>>,
+#    "splits": {"train": [file names], "test": [file names], ...},
+#    "options": how the scheme was drawn}
+# Any number of schemes can live side by side, and writing one is instant.
+#
+# Sequences are assigned by contiguous time blocks (a month, a run of
+# consecutive sequences...) rather than one by one, so that neighbouring
+# sequences, which look alike, do not end up on both sides of a split. Blocks
+# are ranked by a draw that only depends on the seed and on the block, and the
+# first `ratio` of them go to test, so a scheme drawn again after sequences
+# were added keeps the split of nearly all the earlier ones: a test block only
+# goes back to train when a new block ranks before it.
+
+
+DEFAULT_SCHEME = "default"
+
+
+def split_path(data_folder: str, name: str) -> str:
+    return os.path.join(data_folder, "splits", f"{name}.json")
+
+
+def block_split(
+    names: list[str], blocks: list, ratio: float = 0.2, seed: int = 0
+) -> dict[str, list[str]]:
+    # `blocks` holds the block of every sequence, as a string or an integer;
+    # at least one block goes to test, and one stays in train, when there are
+    # enough of them
+    ranked = sorted(
+        set(blocks),
+        key=lambda block: np.random.default_rng([seed, _block_key(block)]).random(),
+    )
+    n_test = max(1, math.ceil(ratio * len(ranked))) if ratio > 0 else 0
+    test_blocks = set(ranked[: min(n_test, len(ranked) - 1)])
+    splits = {"train": [], "test": []}
+    for name, block in zip(names, blocks):
+        splits["test" if block in test_blocks else "train"].append(name)
+    return splits
+
+
+def _block_key(block) -> int:
+    # a seed for the block, stable across processes unlike hash()
+    if isinstance(block, str):
+        return int.from_bytes(block.encode(), "little")
+    return int(block)
+
+
+def write_splits(
+    data_folder: str,
+    name: str,
+    splits: dict[str, list[str]],
+    folder: str = "sequences",
+    options: dict = None,
+):
+    path = split_path(data_folder, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(
+            {
+                "folder": folder,
+                "splits": {split: sorted(names) for split, names in splits.items()},
+                "options": options or {},
+            },
+            f,
+        )
+    os.replace(path + ".tmp", path)
+
+
+def read_splits(data_folder: str, name: str) -> dict:
+    path = split_path(data_folder, name)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No split scheme {name} in {data_folder}")
+    with open(path) as f:
+        return json.load(f)
+
+
+def select_files(
+    index: np.ndarray, file_ids: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    # the rows of a window index (see window_index.py) of the files `file_ids`,
+    # renumbered as positions in file_ids, and where they are in the index;
+    # derived files of a folder are thereby shared by all of its splits
+    file_ids = np.asarray(file_ids, dtype=np.int64)
+    n_files = int(index[:, 0].max()) + 1 if len(index) > 0 else 0
+    new_ids = np.full(max(n_files, int(file_ids.max(initial=-1)) + 1), -1)
+    new_ids[file_ids] = np.arange(len(file_ids))
+    rows = np.flatnonzero(new_ids[index[:, 0]] >= 0)
+    selected = index[rows].copy()
+    selected[:, 0] = new_ids[selected[:, 0]]
+    # sorted by file like any window index, when file_ids are not
+    order = np.argsort(selected[:, 0], kind="stable")
+    return selected[order], rows[order]
+
+
+def file_ids(folder_files: tuple[str, ...], files: list[str] = None) -> np.ndarray:
+    # positions of `files` among the sequences of their folder, in folder order
+    if files is None:
+        return np.arange(len(folder_files))
+    positions = {fn: i for i, fn in enumerate(folder_files)}
+    missing = [fn for fn in files if fn not in positions]
+    if len(missing) > 0:
+        raise FileNotFoundError(
+            f"{len(missing)} sequences of the split are missing, e.g. {missing[0]}"
+        )
+    return np.sort(np.array([positions[fn] for fn in files], dtype=np.int64))
@@ -0,0 +1,350 @@
+import os
+import json
+import numpy as np
+import torch as t
+from typing import Callable
+from tqdm import tqdm
+from .files import atomic_write, file_lock
+from .sharding import default_seed, shard_order, shard_size
+
+# The window index lists every valid window of a split as a (file, offset) row,
+# so windows can be drawn in any order without reading the files up front.
+# Sequences are truncated to a multiple of the window size before windowing,
+# exactly like the loaders do.
+#
+# Next to it, `rain_<window>_<crop>.npz` holds per-window statistics aligned
+# with the index rows: the fraction of rainy (non zero) pixels of the input and
+# of the target frames, and the mean intensity of the whole window.
+
+
+def count_windows(length: int, window_size: int, truncate: bool = True) -> int:
+    # windows with a step of one frame, in the sequence truncated to a multiple
+    # of the window size unless `truncate` is off; the rule of every loader
+    if truncate:
+        length = (length // window_size) * window_size
+    return max(length - window_size + 1, 0)
+
+
+def build_window_index(
+    lengths: list[int], window_size: int, truncate: bool = True
+) -> np.ndarray:
+    rows = []
+    for file_id, length in enumerate(lengths):
+        n_windows = count_windows(length, window_size, truncate)
+        offsets = np.arange(n_windows, dtype=np.int64)
+        rows.append(np.stack((np.full_like(offsets, file_id), offsets), axis=1))
+    if len(rows) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    return np.concatenate(rows)
+
+
+def index_folder(folder: str) -> str:
+    # derived files of <data>/<split> live in <data>/index/<split>, so the split
+    # folders only ever contain sequences; it is only created to write them
+    folder = os.path.normpath(folder)
+    return os.path.join(os.path.dirname(folder), "index", os.path.basename(folder))
+
+
+def sequence_lengths(folder: str, files: tuple[str, ...]) -> list[int]:
+    # lengths are cached with the size of the file, so every file is only read
+    # again when it was rewritten (sequences can be extended by preprocessing)
+    cache_path = os.path.join(index_folder(folder), "lengths.json")
+    sizes = {fn: os.path.getsize(os.path.join(folder, fn)) for fn in files}
+
+    def read_cache() -> tuple[dict, list[str]]:
+        cache = {}
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                cache = json.load(f)
+        missing = [
+            fn
+            for fn in files
+            if not isinstance(cache.get(fn), list) or cache[fn][1] != sizes[fn]
+        ]
+        return cache, missing
+
+    cache, missing = read_cache()
+    if len(missing) > 0:
+        with file_lock(cache_path) as writable:
+            cache, missing = read_cache()
+            for fn in tqdm(
+                missing, desc="Indexing sequences", disable=len(missing) == 0
+            ):
+                cache[fn] = [len(t.load(os.path.join(folder, fn))), sizes[fn]]
+            if len(missing) > 0 and writable:
+                with atomic_write(cache_path) as f:
+                    json.dump(cache, f)
+    return [cache[fn][0] for fn in files]
+
+
+def load_window_index(
+    folder: str, files: tuple[str, ...], window_size: int, lengths: list[int] = None
+) -> np.ndarray:
+    index_path = os.path.join(index_folder(folder), f"windows_{window_size}.npz")
+    if lengths is None:
+        lengths = sequence_lengths(folder, files)
+
+    def read_cache() -> np.ndarray:
+        if os.path.exists(index_path):
+            cached = np.load(index_path)
+            if tuple(cached["files"]) == tuple(files) and (
+                "lengths" in cached and cached["lengths"].tolist() == list(lengths)
+            ):
+                return cached["index"]
+        return None
+
+    index = read_cache()
+    if index is not None:
+        return index
+    with file_lock(index_path) as writable:
+        index = read_cache()
+        if index is None:
+            index = build_window_index(lengths, window_size)
+            if writable:
+                with atomic_write(index_path, "wb") as f:
+                    np.savez(
+                        f,
+                        index=index,
+                        files=np.array(files),
+                        lengths=np.array(lengths, dtype=np.int64),
+                    )
+    return index
+
+
+def _frame_stats(data: t.Tensor, crop: int = None) -> tuple[np.ndarray, np.ndarray]:
+    if crop is not None:
+        data = data[..., :crop, :crop]
+    frames = data.reshape(len(data), -1)
+    return (
+        (frames != 0).double().mean(dim=1).numpy(),
+        frames.double().mean(dim=1).numpy(),
+    )
+
+
+def _window_means(values: np.ndarray, offsets: np.ndarray, size: int) -> np.ndarray:
+    # mean of values[o : o + size] for every offset, from a cumulative sum
+    cumsum = np.concatenate(([0.0], np.cumsum(values)))
+    return (cumsum[offsets + size] - cumsum[offsets]) / size
+
+
+def window_rain_stats(
+    folder: str,
+    files: tuple[str, ...],
+    index: np.ndarray,
+    window_size: int,
+    in_len: int,
+    crop: int = None,
+    load: Callable[[int], t.Tensor] = None,
+) -> dict[str, np.ndarray]:
+    # every sequence is read once, the result is cached for the crop
+    stats_path = os.path.join(
+        index_folder(folder), f"rain_{window_size}_{crop or 'full'}.npz"
+    )
+    if load is None:
+
+        def load(file_id: int) -> t.Tensor:
+            return t.load(os.path.join(folder, files[file_id]))
+
+    def read_cache() -> dict[str, np.ndarray]:
+        if os.path.exists(stats_path):
+            cached = np.load(stats_path)
+            if tuple(cached["files"]) == tuple(files) and len(cached["x"]) == len(
+                index
+            ):
+                return {key: cached[key] for key in ("x", "y", "intensity")}
+        return None
+
+    stats = read_cache()
+    if stats is not None:
+        return stats
+    with file_lock(stats_path) as writable:
+        stats = read_cache()
+        if stats is None:
+            stats = _rain_stats(files, index, window_size, in_len, crop, load)
+            if writable:
+                with atomic_write(stats_path, "wb") as f:
+                    np.savez(f, files=np.array(files), **stats)
+    return stats
+
+
+def _rain_stats(
+    files: tuple[str, ...],
+    index: np.ndarray,
+    window_size: int,
+    in_len: int,
+    crop: int,
+    load: Callable[[int], t.Tensor],
+) -> dict[str, np.ndarray]:
+    stats = {key: np.zeros(len(index)) for key in ("x", "y", "intensity")}
+    starts = np.searchsorted(index[:, 0], np.arange(len(files) + 1))
+    for file_id in tqdm(range(len(files)), desc="Indexing rain"):
+        start, stop = starts[file_id], starts[file_id + 1]
+        if start == stop:
+            continue
+        offsets = index[start:stop, 1]
+        rain, intensity = _frame_stats(load(file_id), crop)
+        stats["x"][start:stop] = _window_means(rain, offsets, in_len)
+        stats["y"][start:stop] = _window_means(
+            rain, offsets + in_len, window_size - in_len
+        )
+        stats["intensity"][start:stop] = _window_means(intensity, offsets, window_size)
+    return stats
+
+
+class WindowSampler:
+    # Yields batches of index rows. With `files_in_flight` the shuffle is done
+    # within groups of that many files (a shuffle buffer), which keeps random
+    # access cheap when files have to be decoded whole; without it, windows are
+    # shuffled across the whole split. `num_samples` cuts epochs short and
+    # `weights` draws windows with replacement proportionally to their weight;
+    # with `files_in_flight` too, the windows drawn are then read grouped by
+    # file, in groups of that many files.
+    # With `world_size` > 1 only the block of the epoch's order that belongs to
+    # `rank` is yielded; all ranks must share the seed.
+    def __init__(
+        self,
+        index: np.ndarray,
+        batch_size: int,
+        *,
+        shuffle: bool = True,
+        files_in_flight: int = None,
+        num_samples: int = None,
+        weights: t.Tensor = None,
+        seed: int = None,
+        rank: int = 0,
+        world_size: int = 1,
+        drop_last: bool = False,
+    ):
+        self.index = index
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.files_in_flight = files_in_flight
+        self.num_samples = num_samples
+        self.weights = weights
+        self.seed = default_seed(world_size) if seed is None else seed
+        self.rank = rank
+        self.world_size = world_size
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        n = len(self.index) if self.num_samples is None else self.num_samples
+        n = shard_size(n, self.world_size, self.drop_last)
+        return (n + self.batch_size - 1) // self.batch_size
+
+    def order(self) -> t.Tensor:
+        return self.grouped_order()[0]
+
+    def grouped_order(self) -> tuple[t.Tensor, t.Tensor]:
+        # the order of the epoch, and the file group of each of its windows
+        # (None without `files_in_flight`)
+        generator = t.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        file_ids = self.index[:, 0]
+        n_files = int(file_ids.max()) + 1 if len(file_ids) > 0 else 0
+        if self.weights is not None:
+            n = len(self.index) if self.num_samples is None else self.num_samples
+            order = t.multinomial(
+                self.weights, n, replacement=True, generator=generator
+            )
+            if self.files_in_flight is None:
+                return order, None
+            # draws are independent, so they stay in random order within the
+            # group of their file, groups being visited in a shuffled order
+            file_groups = t.empty(n_files, dtype=t.long)
+            file_groups[t.randperm(n_files, generator=generator)] = (
+                t.arange(n_files) // self.files_in_flight
+            )
+            groups = file_groups[t.from_numpy(file_ids)[order]]
+            groups, sort = t.sort(groups, stable=True)
+            return order[sort], groups
+        if self.files_in_flight is None:
+            if not self.shuffle:
+                order = t.arange(len(self.index))
+            else:
+                order = t.randperm(len(self.index), generator=generator)
+            return order[: self.num_samples], None
+        if not self.shuffle:
+            order = t.arange(len(self.index))
+            groups = t.from_numpy(file_ids // self.files_in_flight)
+        else:
+            # the index is sorted by file, so each file is a contiguous range
+            starts = np.searchsorted(file_ids, np.arange(n_files + 1))
+            file_order = t.randperm(n_files, generator=generator).tolist()
+            orders, groups = [], []
+            for i in range(0, n_files, self.files_in_flight):
+                group = t.cat(
+                    tuple(
+                        t.arange(starts[f], starts[f + 1])
+                        for f in file_order[i : i + self.files_in_flight]
+                    )
+                )
+                orders.append(group[t.randperm(len(group), generator=generator)])
+                groups.append(t.full((len(group),), len(groups)))
+            order = t.cat(orders) if len(orders) > 0 else t.arange(0)
+            groups = t.cat(groups) if len(groups) > 0 else t.arange(0)
+        return order[: self.num_samples], groups[: self.num_samples]
+
+    def worker_batches(self, worker: int = 0, num_workers: int = 1) -> list:
+        # the batches of this rank read by `worker`, for loaders with worker
+        # processes: the windows of each file group are batched on their own
+        # and whole groups are dealt to the worker with the fewest windows so
+        # far, so that every file is decoded by a single worker; without file
+        # groups, batches are dealt one by one
+        order, groups = self.grouped_order()
+        positions = shard_order(
+            t.arange(len(order)), self.rank, self.world_size, self.drop_last
+        )
+        order = order[positions].numpy()
+        if groups is None:
+            batches = [
+                self.index[order[i : i + self.batch_size]]
+                for i in range(0, len(order), self.batch_size)
+            ]
+            return batches[worker::num_workers]
+        # runs of windows of the same group; the block of a rank can wrap
+        # around to the start of the order
+        groups = groups[positions].numpy()
+        bounds = [0, *(np.flatnonzero(np.diff(groups)) + 1).tolist(), len(groups)]
+        n_windows = [0] * num_workers
+        batches = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            w = n_windows.index(min(n_windows))
+            n_windows[w] += stop - start
+            if w == worker:
+                batches.extend(
+                    self.index[order[i : min(i + self.batch_size, stop)]]
+                    for i in range(start, stop, self.batch_size)
+                )
+        return batches
+
+    def __iter__(self):
+        order = shard_order(
+            self.order(), self.rank, self.world_size, self.drop_last
+        ).numpy()
+        for i in range(0, len(order), self.batch_size):
+            yield self.index[order[i : i + self.batch_size]]
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    from .window_store import list_sequence_files
+
+    parser = ArgumentParser()
+    parser.add_argument("-d", "--data-folder", type=str)
+    parser.add_argument(
+        "-s", "--splits", type=str, nargs="+", default=["train", "test"]
+    )
+    parser.add_argument("-t", "--time-steps", type=int, default=4)
+    parser.add_argument("-c", "--crop", type=int, default=None)
+    args = parser.parse_args()
+    for split in args.splits:
+        folder = os.path.join(args.data_folder, split)
+        files = list_sequence_files(folder)
+        index = load_window_index(folder, files, 2 * args.time_steps)
+        window_rain_stats(
+            folder, files, index, 2 * args.time_steps, args.time_steps, args.crop
+        )
@@ -0,0 +1,277 @@
+import os
+import json
+import numpy as np
+import torch as t
+from functools import lru_cache
+from tqdm import tqdm
+from .files import atomic_write, file_lock, temp_path
+from .window_index import sequence_lengths
+
+# A window store packs every preprocessed sequence of a split into one
+# contiguous file that can be memory-mapped, so reading a window is a slice of
+# the map instead of unpickling a whole `.pt` file.
+#
+# Layout of a store folder:
+#   frames.bin   -> raw frames, shape (n_frames, *frame_shape), C order
+#   offsets.npy  -> int64 array of length n_files + 1, sequence i spans
+#                   frames[offsets[i]:offsets[i + 1]]
+#   meta.json    -> dtype (that of the sequences, see frame_dtype, unless one is
+#                   given), frame_shape, source file names; written last, a
+#                   store is complete once it exists
+#   tiles_<n>.bin -> optional copy of the frames split in n x n spatial tiles,
+#                   shape (tiles_y, tiles_x, n_frames, regions, n, n), so that
+#                   each tile is contiguous over time and a top-left crop only
+#                   touches the tiles it overlaps
+
+
+# listings and opened stores are cached, so loaders can be created repeatedly
+# without walking the split folders again
+@lru_cache(maxsize=None)
+def list_sequence_files(folder: str) -> tuple[str, ...]:
+    return tuple(sorted(fn for fn in os.listdir(folder) if fn.endswith(".pt")))
+
+
+def store_path(data_folder: str, split: str) -> str:
+    return os.path.join(data_folder, "store", split)
+
+
+def frame_dtype(dtype) -> np.dtype:
+    # frames are kept in the dtype of their sequences, except int64 sequences,
+    # written before preprocessing stored a narrow dtype, which fit in uint8
+    dtype = np.dtype(dtype)
+    return np.dtype(np.uint8) if dtype == np.int64 else dtype
+
+
+def build_store(folder: str, out_folder: str, dtype: str = None) -> "WindowStore":
+    os.makedirs(out_folder, exist_ok=True)
+    files = list_sequence_files(folder)
+    np_dtype = None if dtype is None else np.dtype(dtype)
+    offsets = [0]
+    frame_shape = None
+    # under temporary names, a process may have the previous frames mapped
+    with atomic_write(os.path.join(out_folder, "frames.bin"), "wb") as f:
+        for fn in tqdm(files):
+            data = t.load(os.path.join(folder, fn))
+            if np_dtype is None:
+                np_dtype = frame_dtype(data.numpy().dtype)
+            if frame_shape is None:
+                frame_shape = tuple(data.shape[1:])
+            assert (
+                tuple(data.shape[1:]) == frame_shape
+            ), f"{fn} has frames of shape {tuple(data.shape[1:])}, not {frame_shape}"
+            info = np.iinfo(np_dtype) if np_dtype.kind in "iu" else None
+            if (
+                info is not None
+                and len(data) > 0
+                and (data.min() < info.min or data.max() > info.max)
+            ):
+                raise ValueError(
+                    f"{fn} has values outside the range of {np_dtype.name}, "
+                    "pass a wider dtype"
+                )
+            f.write(data.numpy().astype(np_dtype).tobytes())
+            offsets.append(offsets[-1] + len(data))
+    with atomic_write(os.path.join(out_folder, "offsets.npy"), "wb") as f:
+        np.save(f, np.array(offsets, dtype=np.int64))
+    # tiles of an earlier store do not match the new frames
+    for fn in os.listdir(out_folder):
+        if fn.startswith("tiles_") and fn.endswith(".bin"):
+            os.remove(os.path.join(out_folder, fn))
+    if np_dtype is None:
+        np_dtype = np.dtype(np.uint8)
+    with atomic_write(os.path.join(out_folder, "meta.json")) as f:
+        json.dump(
+            {"dtype": np_dtype.name, "frame_shape": frame_shape, "files": files}, f
+        )
+    return WindowStore(out_folder)
+
+
+def build_tiles(store: "WindowStore", tile_size: int, block: int = 1024):
+    *lead, height, width = store.frames.shape[1:]
+    if tile_size >= max(height, width):
+        # a single tile would be a second copy of the frames, which are read
+        # whole for such crops anyway
+        return
+    n_y, n_x = -(-height // tile_size), -(-width // tile_size)
+    tiles_path = os.path.join(store.folder, f"tiles_{tile_size}.bin")
+    tiles = np.memmap(
+        temp_path(tiles_path),
+        dtype=store.frames.dtype,
+        mode="w+",
+        shape=(n_y, n_x, len(store.frames), *lead, tile_size, tile_size),
+    )
+    # copied in blocks of frames to keep memory bounded; edge tiles are zero
+    # padded when the frame size is not a multiple of the tile size
+    for start in tqdm(range(0, len(store.frames), block), desc="Tiling"):
+        frames = store.frames[start : start + block]
+        for ty in range(n_y):
+            for tx in range(n_x):
+                tile = frames[
+                    ...,
+                    ty * tile_size : (ty + 1) * tile_size,
+                    tx * tile_size : (tx + 1) * tile_size,
+                ]
+                out = tiles[ty, tx, start : start + len(frames)]
+                out[...] = 0
+                out[..., : tile.shape[-2], : tile.shape[-1]] = tile
+    tiles.flush()
+    del tiles
+    os.replace(temp_path(tiles_path), tiles_path)
+    with open(os.path.join(store.folder, "meta.json")) as f:
+        meta = json.load(f)
+    meta["tile_size"] = tile_size
+    with atomic_write(os.path.join(store.folder, "meta.json")) as f:
+        json.dump(meta, f)
+    store.open_tiles(tile_size)
+
+
+class WindowStore:
+    def __init__(self, folder: str):
+        self.folder = folder
+        with open(os.path.join(folder, "meta.json")) as f:
+            meta = json.load(f)
+        self.files = tuple(meta["files"])
+        self.offsets = np.load(os.path.join(folder, "offsets.npy"))
+        # copy-on-write keeps the map read-only on disk while giving torch a
+        # writable array, so `t.from_numpy` does not need to copy
+        self.frames = np.memmap(
+            os.path.join(folder, "frames.bin"),
+            dtype=np.dtype(meta["dtype"]),
+            mode="c",
+            shape=(int(self.offsets[-1]), *meta["frame_shape"]),
+        )
+        self.tiles = None
+        if meta.get("tile_size") is not None:
+            self.open_tiles(meta["tile_size"])
+
+    def __getstate__(self):
+        # worker processes map the files again instead of receiving a copy
+        return {
+            "folder": self.folder,
+            "tile_size": self.tile_size if self.tiles is not None else None,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(state["folder"])
+        tile_size = state["tile_size"]
+        if tile_size is not None and getattr(self, "tile_size", None) != tile_size:
+            self.open_tiles(tile_size)
+
+    def open_tiles(self, tile_size: int):
+        *lead, height, width = self.frames.shape[1:]
+        self.tile_size = tile_size
+        self.tiles = np.memmap(
+            os.path.join(self.folder, f"tiles_{tile_size}.bin"),
+            dtype=self.frames.dtype,
+            mode="c",
+            shape=(
+                -(-height // tile_size),
+                -(-width // tile_size),
+                len(self.frames),
+                *lead,
+                tile_size,
+                tile_size,
+            ),
+        )
+
+    def __len__(self):
+        return len(self.files)
+
+    def sequence(
+        self, i: int, crop: int = None, start: int = 0, stop: int = None
+    ) -> t.Tensor:
+        # frames start:stop of sequence i
+        first, last = self.offsets[i], self.offsets[i + 1]
+        start, stop, _ = slice(start, stop).indices(last - first)
+        start, stop = first + start, first + max(start, stop)
+        height, width = self.frames.shape[-2:]
+        if self.tiles is None or crop is None or crop >= max(height, width):
+            frames = t.from_numpy(self.frames[start:stop])
+            return frames if crop is None else frames[..., :crop, :crop]
+        n_tiles = -(-crop // self.tile_size)
+        if n_tiles == 1:
+            # the crop lies in the first tile, a view of a contiguous block
+            return t.from_numpy(self.tiles[0, 0, start:stop])[..., :crop, :crop]
+        # only the tiles overlapping the crop are read
+        size = n_tiles * self.tile_size
+        out = np.empty(
+            (stop - start, *self.frames.shape[1:-2], size, size), self.frames.dtype
+        )
+        for ty in range(min(n_tiles, self.tiles.shape[0])):
+            for tx in range(min(n_tiles, self.tiles.shape[1])):
+                out[
+                    ...,
+                    ty * self.tile_size : (ty + 1) * self.tile_size,
+                    tx * self.tile_size : (tx + 1) * self.tile_size,
+                ] = self.tiles[ty, tx, start:stop]
+        return t.from_numpy(out)[..., :crop, :crop]
+
+    def window(
+        self, i: int, start: int, in_len: int = 4, out_len: int = 4
+    ) -> tuple[t.Tensor, t.Tensor]:
+        seq = self.sequence(i)
+        assert start + in_len + out_len <= len(
+            seq
+        ), f"window {start} does not fit in sequence {i} of length {len(seq)}"
+        return (
+            seq[start : start + in_len],
+            seq[start + in_len : start + in_len + out_len],
+        )
+
+
+@lru_cache(maxsize=None)
+def open_store(
+    data_folder: str, split: str, build: bool = True, tile_size: int = None
+) -> WindowStore:
+    path = store_path(data_folder, split)
+    if not build and not os.path.exists(os.path.join(path, "meta.json")):
+        raise FileNotFoundError(f"No window store found at {path}")
+    folder = os.path.join(data_folder, split)
+    # every rank opens the store at startup, one of them builds it
+    with file_lock(path):
+        if os.path.exists(os.path.join(path, "meta.json")):
+            store = WindowStore(path)
+            # sequences added or extended since the store was built make it
+            # stale, it is built again with its tiles
+            files = list_sequence_files(folder)
+            lengths = np.diff(store.offsets).tolist()
+            if store.files != files or lengths != sequence_lengths(folder, files):
+                if not build:
+                    raise FileNotFoundError(
+                        f"The window store at {path} is out of date"
+                    )
+                print(f"Rebuilding the out of date window store for {split} in {path}")
+                store = build_store(folder, path)
+        else:
+            print(f"Building window store for {split} in {path}")
+            store = build_store(folder, path)
+        if tile_size is not None and (
+            store.tiles is None or store.tile_size != tile_size
+        ):
+            if os.path.exists(os.path.join(path, f"tiles_{tile_size}.bin")):
+                store.open_tiles(tile_size)
+            elif build:
+                build_tiles(store, tile_size)
+    return store
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument("-d", "--data-folder", type=str)
+    parser.add_argument(
+        "-s", "--splits", type=str, nargs="+", default=["train", "test"]
+    )
+    # that of the sequences by default
+    parser.add_argument("--dtype", type=str, default=None)
+    parser.add_argument("--tile-size", type=int, default=20)  # 0 to disable
+    args = parser.parse_args()
+    for split in args.splits:
+        store = build_store(
+            os.path.join(args.data_folder, split),
+            store_path(args.data_folder, split),
+            dtype=args.dtype,
+        )
+        if args.tile_size > 0:
+            build_tiles(store, args.tile_size)
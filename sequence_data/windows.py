@@ -0,0 +1,18 @@
+import torch as t
+
+# Sliding windows as strided views: window i of `windows` shares memory with
+# data[i * step : i * step + size], so building them costs no copies and no
+# Python loop. Only indexing a batch out of them materialises data.
+
+
+def sliding_windows(data: t.Tensor, size: int, step: int = 1) -> t.Tensor:
+    n_windows = max((len(data) - size) // step + 1, 0)
+    return data.as_strided(
+        (n_windows, size, *data.shape[1:]),
+        (step * data.stride(0), *data.stride()),
+        data.storage_offset(),
+    )
+
+
+def split_windows(windows: t.Tensor, in_len: int) -> tuple[t.Tensor, t.Tensor]:
+    return windows[:, :in_len], windows[:, in_len:]